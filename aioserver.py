@@ -0,0 +1,242 @@
+import asyncio
+import time
+from tftp import TFTP
+from server import Server
+from scheduler import Scheduler
+from logger import log
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+
+class TransferProtocol(asyncio.DatagramProtocol):
+    """ A single transfer served on the event loop from its own port (TID).
+        The TFTP methods send through the datagram transport the same way as
+        through a socket, the retransmission timer is a timer of the loop """
+
+    def __init__(self, server, transfer, packet, addr_client, mode):
+        self.__server = server
+        self.__transfer = transfer
+        self.__packet = packet # first packet to send (None for the first DATA window)
+        self.__addr_client = addr_client
+        self.__mode = mode
+        self.__transport = None
+        self.__timer = None
+        self.__due = 0 # time the timer fires
+        self.__dallying = False # the final ACK was sent, answer a retransmitted last DATA
+        self.__held = None # packets received while the transfer is paced (its share of the rate limit)
+        self.__moved = 0 # bytes of the transfer when the last packet was handled
+        self.__closed = False # the transfer was closed and finished
+
+
+    def connection_made(self, transport):
+        self.__transport = transport
+        self.__server.begin_transfer(self.__transfer, self.__packet, transport, self.__addr_client, self.__mode)
+        self.schedule(self.__transfer.timeout())
+
+
+    def schedule(self, delay):
+        # the timer fires once per timeout, the packets only move the transfer's deadline 
+        # which is cheaper than re-arming the timer for every packet
+        self.__due = time.monotonic() + delay
+        self.__timer = asyncio.get_running_loop().call_later(delay, self.check_timeout)
+
+
+    def datagram_received(self, packet, addr):
+        if self.__held is not None:
+            self.__held.append((packet, addr))
+            return
+
+        try:
+            if self.__dallying:
+                if addr == self.__addr_client:
+                    TFTP.answer_dally(self.__transfer, packet, self.__transport, self.__addr_client)
+
+            elif not self.__server.handle_packet(self.__transfer, packet, addr, self.__transport,
+                                                    self.__addr_client, self.__mode):
+                if not self.__transfer.final_acked:
+                    self.finish()
+                    return
+
+                # the upload is complete, it's written and the slot given back before the dally
+                self.close_transfer()
+                # wait one timeout before closing the port
+                self.__dallying = True
+                self.__timer.cancel()
+                self.schedule(self.__transfer.rtt.Rto)
+
+            elif self.__transfer.deadline < self.__due:
+                # the timeout got shorter (a new RTT sample), the timer must fire earlier
+                self.__timer.cancel()
+                self.schedule(self.__transfer.timeout())
+
+            if not self.__dallying and not self.__transport.is_closing():
+                # keep the share of the rate limit, the next packets wait
+                pause = self.__server.pace(self.__transfer, self.__transfer.bytes - self.__moved)
+                self.__moved = self.__transfer.bytes
+                if pause:
+                    self.__held = []
+                    asyncio.get_running_loop().call_later(pause, self.resume)
+
+        except Exception as e:
+            log.error("Transfer error (%s): %s", self.__addr_client, e)
+            self.finish()
+
+
+    def resume(self):
+        # handle the packets held while paced (until it's paced again)
+        held, self.__held = self.__held, None
+        while held and self.__held is None and not self.__transport.is_closing():
+            self.datagram_received(*held.pop(0))
+        if held and self.__held is not None:
+            self.__held[:0] = held
+
+
+    def error_received(self, exc):
+        # ICMP errors (like port unreachable) - the retransmissions end the transfer
+        pass
+
+
+    def check_timeout(self):
+        if self.__held is not None:
+            # paced, the answer of the peer is maybe held
+            self.schedule(self.__transfer.timeout())
+            return
+
+        if self.__dallying:
+            self.finish()
+            return
+
+        if time.monotonic() < self.__transfer.deadline:
+            # packets were received meanwhile, wait until the new deadline
+            self.schedule(self.__transfer.timeout())
+            return
+
+        # resend the last packet, give up once the retry budget is spent 
+        try:
+            if not self.__server.retransmit(self.__transfer, self.__transport, self.__addr_client, self.__mode):
+                log.warning("Connection timeouts (%s)", self.__addr_client)
+                self.finish()
+                return
+        except Exception as e:
+            log.error("Transfer error (%s): %s", self.__addr_client, e)
+            self.finish()
+            return
+
+        self.schedule(self.__transfer.timeout())
+
+
+    def finish(self):
+        if self.__timer is not None:
+            self.__timer.cancel()
+        self.__transport.close()
+
+
+    def connection_lost(self, exc):
+        # flush the written data also when the transfer failed
+        self.close_transfer()
+
+
+    def close_transfer(self):
+        if self.__closed:
+            return
+        self.__closed = True
+        try:
+            self.__transfer.close()
+        except OSError as e:
+            log.error("Transfer error (%s): %s", self.__addr_client, e)
+        finally:
+            # the slot of the transfer is given back whatever the close did
+            self.__server.finish_transfer(self.__transfer, self.__addr_client)
+
+
+
+class RequestProtocol(asyncio.DatagramProtocol):
+    """ Receive the RRQ/WRQ requests on the TFTP port """
+
+    def __init__(self, server):
+        self.__server = server
+        self.__transport = None
+
+    def connection_made(self, transport):
+        self.__transport = transport
+
+    def datagram_received(self, packet, addr):
+        self.__server.submit_request(packet, addr, self.__transport)
+
+    def error_received(self, exc):
+        pass
+
+
+
+class AsyncServer(Server):
+    """ Serve all the transfers on one asyncio event loop instead of a thread per transfer,
+        the requests are validated and the transfers are run by the Server methods """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__tasks = set() # keep a reference of the running tasks
+
+
+    def start_request(self, packet_req, addr_client, main_transport):
+        try:
+            result = self.open_transfer(packet_req, addr_client, main_transport)
+        except Exception as e:
+            log.error("Error: %s", e)
+            return False
+
+        if result is None:
+            return False # an error was sent to the client
+
+        task = asyncio.get_running_loop().create_task(self.serve_transfer(addr_client, *result))
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+        return True
+
+
+    async def serve_transfer(self, addr_client, transfer, packet, mode, timeout):
+        try:
+            client_sock = self.open_client_socket(transfer, addr_client, timeout)
+            await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: TransferProtocol(self, transfer, packet, addr_client, mode), sock=client_sock)
+        except Exception as e:
+            log.error("Error: %s", e)
+            transfer.close()
+            self.end_request(addr_client)
+
+
+    async def serve(self):
+        self.log("Starting tftp server (asyncio engine)")
+        main_sock = self.create_main_socket()
+        self.log(f"TFTP server is listening on ({main_sock.getsockname()})..")
+
+        transport, protocol = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: RequestProtocol(self), sock=main_sock)
+        try:
+            while True:
+                # serve forever, the requests that expired in the queue are refused also without traffic
+                await asyncio.sleep(Scheduler.EXPIRE_INTERVAL)
+                self.expire_requests()
+        finally:
+            transport.close()
+
+
+    def run_server(self):
+        raise_open_files_limit()
+        asyncio.run(self.serve())
+
+
+
+def raise_open_files_limit():
+    # every transfer holds a socket and a file, thousands of concurrent
+    # transfers need more than the default soft limit
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
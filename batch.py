@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import glob
+import json
+import os
+import socket
+import time
+from client import Client
+from tftp import TFTP
+from logger import log, setup_logging
+
+
+class ClientProtocol(asyncio.DatagramProtocol):
+    """ A single get/put transfer of the batch on the event loop.
+        The packets are handled by the Client methods (like by the blocking client),
+        the retransmission timer is a timer of the loop """
+
+    def __init__(self, client, done):
+        self.__client = client
+        self.__done = done # future of the result (True if the transfer completed)
+        self.__transport = None
+        self.__timer = None
+        self.__due = 0 # time the timer fires
+        self.__dallying = False # the final ACK was sent, answer a retransmitted last DATA
+        self.__server_addr = None
+        self.__exception = None # raised by the transfer (like a missing local file)
+
+
+    def connection_made(self, transport):
+        self.__transport = transport
+        try:
+            self.__client.send_request(transport)
+        except Exception as e:
+            self.__exception = e
+            transport.close()
+            return
+        self.schedule(self.__client.wait_time())
+
+
+    def schedule(self, delay):
+        if self.__timer is not None:
+            self.__timer.cancel()
+        self.__due = time.monotonic() + delay
+        self.__timer = asyncio.get_running_loop().call_later(delay, self.check_timeout)
+
+
+    def datagram_received(self, packet, addr):
+        transfer = self.__client.ActiveTransfer
+        try:
+            if self.__dallying:
+                if addr == self.__server_addr:
+                    TFTP.answer_dally(transfer, packet, self.__transport, addr)
+                return
+
+            if not self.__client.handle_packet(packet, addr, self.__transport):
+                transfer = self.__client.ActiveTransfer
+                if transfer is None or not transfer.final_acked:
+                    self.finish()
+                    return
+
+                # wait one timeout before closing the port
+                self.__server_addr = addr
+                self.__dallying = True
+                self.schedule(transfer.rtt.Rto)
+                return
+
+            transfer = self.__client.ActiveTransfer
+            if transfer is not None and transfer.deadline < self.__due:
+                # the timeout got shorter (a new RTT sample), the timer must fire earlier
+                self.schedule(transfer.timeout())
+
+        except Exception as e:
+            self.__exception = e
+            self.finish()
+
+
+    def error_received(self, exc):
+        # ICMP errors (like port unreachable) - the retransmissions end the transfer
+        pass
+
+
+    def check_timeout(self):
+        transfer = self.__client.ActiveTransfer
+        if self.__dallying:
+            self.finish()
+            return
+
+        if transfer is not None and time.monotonic() < transfer.deadline:
+            # packets were received meanwhile, wait until the new deadline
+            self.schedule(transfer.timeout())
+            return
+
+        # resend the last packet (or the request), give up once the retry budget is spent
+        try:
+            if not self.__client.handle_timeout(self.__transport):
+                self.finish()
+                return
+        except Exception as e:
+            self.__exception = e
+            self.finish()
+            return
+
+        self.schedule(self.__client.wait_time())
+
+
+    def finish(self):
+        if self.__timer is not None:
+            self.__timer.cancel()
+        self.__transport.close()
+
+
+    def connection_lost(self, exc):
+        # flush the written data also when the transfer failed
+        try:
+            ok = self.__client.finish()
+        except Exception as e:
+            # like a local write failure of the flush, the transfer failed
+            ok = False
+            if self.__exception is None:
+                self.__exception = e
+        if self.__exception is not None:
+            self.__done.set_exception(self.__exception)
+        else:
+            self.__done.set_result(ok)
+
+
+
+class BatchClient:
+    """ Get/put many files in one process: the transfers run concurrently on one asyncio
+        event loop, at most `concurrency` of them at a time.
+        A job is (op, source, target), op is 'get' or 'put', the source is the file on the
+        server (get) or the local file (put) and the target is where it's written, None -
+        the name of the source in the current directory (get) or on the server (put) """
+
+    def __init__(self, host, port=69, concurrency=16, timeout=3, blksize=512, windowsize=1, retries=5,
+                    transfer_mode=TFTP.TRANSFER_MODES[1], is_logging=False):
+        self.__host = host
+        self.__port = port
+        self.__concurrency = concurrency
+        self.__timeout = timeout
+        self.__blksize = blksize
+        self.__windowsize = windowsize
+        self.__retries = retries
+        self.__transfer_mode = transfer_mode
+        self.__is_logging = is_logging # a summary of every transfer
+
+
+    def run(self, jobs):
+        """ Run the jobs, return the report of the batch (see run_async) """
+        return asyncio.run(self.run_async(jobs))
+
+
+    async def run_async(self, jobs):
+        """ Run the jobs on the running event loop, return the report of the batch:
+            the result of every file (in the order of the jobs) and the totals """
+
+        # resolve the server once, not for every packet
+        ip = socket.gethostbyname(self.__host)
+        pool = asyncio.Semaphore(self.__concurrency)
+
+        start = time.monotonic()
+        files = await asyncio.gather(*(self.transfer(ip, pool, *job) for job in jobs))
+        elapsed = time.monotonic() - start
+
+        completed = [f for f in files if f['ok']]
+        total = sum(f['bytes'] for f in completed)
+        return {
+            'files': files,
+            'completed': len(completed),
+            'failed': len(files) - len(completed),
+            'bytes': total,
+            'seconds': elapsed,
+            'mb_per_second': total / elapsed / 1e6 if elapsed else 0.0,
+        }
+
+
+    async def transfer(self, ip, pool, op, source, target=None):
+        if target is None:
+            target = os.path.basename(source)
+
+        async with pool:
+            client = Client(ip, self.__port, op, source, target, self.__timeout, self.__blksize, 1024,
+                            self.__transfer_mode, self.__is_logging, self.__windowsize, self.__retries)
+            loop = asyncio.get_running_loop()
+            done = loop.create_future()
+            start = time.monotonic()
+            error = None
+            try:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                await loop.create_datagram_endpoint(lambda: ClientProtocol(client, done), sock=sock)
+                ok = await done
+            except Exception as e:
+                ok = False
+                error = str(e)
+
+        transfer = client.ActiveTransfer
+        return {
+            'op': op, 'source': source, 'target': target, 'ok': ok,
+            'bytes': transfer.bytes if transfer else 0,
+            'seconds': time.monotonic() - start,
+            'retransmissions': transfer.retransmissions if transfer else 0,
+            'error': None if ok else (error or client.Error or 'Transfer failed'),
+        }
+
+
+
+def read_manifest(path):
+    """ The jobs of a manifest file, a transfer per line: get|put SOURCE [TARGET] ('#' comments) """
+
+    jobs = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            fields = line.split('#', 1)[0].split()
+            if not fields:
+                continue
+            if fields[0] not in ('get', 'put') or len(fields) > 3:
+                raise ValueError(f"{path}:{number}: expected 'get|put SOURCE [TARGET]'")
+            jobs.append((fields[0], fields[1], fields[2] if len(fields) == 3 else None))
+    return jobs
+
+
+def main():
+    # Configuring arguments parser
+    parser = argparse.ArgumentParser(description='Get/put many files concurrently in one process')
+    parser.add_argument('-p', '--port', dest='port', type=int,  default=69, help='server port')
+    parser.add_argument('-t', "--timeout", dest='timeout', type=int, default=3, help="timeout to close the connection")
+    parser.add_argument('-r', "--retries", dest='retries', type=int, default=5, help="retransmissions of a packet before closing the connection")
+    parser.add_argument('-b', '--blksize', dest='blksize', type=int, default=512, help='size in bytes of the data block (default, 512)')
+    parser.add_argument('-w', '--windowsize', dest='windowsize', type=int, default=1, help='number of blocks sent before waiting for an ACK (default, 1)')
+    parser.add_argument('-j', '--concurrency', dest='concurrency', type=int, default=16, help='transfers running at the same time (default, 16)')
+    parser.add_argument('-m', '--manifest', dest='manifest', type=str, default=None, help='file of transfers, one per line: get|put SOURCE [TARGET]')
+    parser.add_argument('--get', dest='get', nargs='+', default=[], metavar='FILE', help='files to get from the server')
+    parser.add_argument('--put', dest='put', nargs='+', default=[], metavar='PATTERN', help='local files (glob patterns) to put on the server')
+    parser.add_argument('-d', '--dest', dest='dest', type=str, default='', help='directory of the files got from the server')
+    parser.add_argument('--json', dest='json', type=str, default=None, help='write the report of the batch to this JSON file')
+    parser.add_argument('--log-level', dest='log_level', choices=['debug', 'info', 'warning', 'error'], default='info', help='messages logged (info - a summary of every transfer)')
+    parser.add_argument('host', type=str, help='Hostname')
+
+    args = parser.parse_args()
+    setup_logging(args.log_level)
+
+    jobs = read_manifest(args.manifest) if args.manifest else []
+    jobs += [('get', name, os.path.join(args.dest, os.path.basename(name))) for name in args.get]
+    for pattern in args.put:
+        paths = sorted(glob.glob(pattern)) or [pattern] # a missing file is reported as failed
+        jobs += [('put', path, None) for path in paths]
+
+    if not jobs:
+        parser.error("no transfers, give --get, --put or a manifest")
+
+    report = BatchClient(args.host, args.port, args.concurrency, args.timeout, args.blksize,
+                            args.windowsize, args.retries, is_logging=True).run(jobs)
+
+    for f in report['files']:
+        if not f['ok']:
+            log.error("[FAILED]: %s %s: %s", f['op'], f['source'], f['error'])
+    log.info("[BATCH]: %d completed, %d failed, %d bytes in %.3fs (%.2f MB/s)", report['completed'],
+                report['failed'], report['bytes'], report['seconds'], report['mb_per_second'])
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    return 1 if report['failed'] else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+import argparse
+import hashlib
+import heapq
+import json
+import os
+import platform
+import random
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from client import Client
+from tftp import TFTP
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+
+
+class LossyProxy:
+    """ UDP proxy emulating a bad link between the clients and the server: every packet
+        (both ways) is delayed, lost, duplicated or reordered with the given probabilities.
+        The clients send to the proxy's port, the proxy forwards each client from its own
+        socket and follows the port (TID) the server answers from, so the clients see
+        a single server address. The random generator is seeded, runs are reproducible """
+
+    REORDER_DELAY = 0.005 # seconds a reordered packet is held back (after the delay)
+
+    def __init__(self, server_addr, delay=0.0, jitter=0.0, loss=0.0, duplicate=0.0, reorder=0.0, seed=0):
+        self.__server_addr = server_addr
+        self.__delay = delay # seconds, one way
+        self.__jitter = jitter # random extra delay up to jitter seconds
+        self.__loss = loss
+        self.__duplicate = duplicate
+        self.__reorder = reorder
+        self.__random = random.Random(seed)
+
+        self.__sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.__sock.bind(('127.0.0.1', 0))
+        self.__upstreams = {} # client address: socket forwarding it to the server
+        self.__servers = {} # client address: server address (its transfer port once it answered)
+        self.__queue = [] # (due time, seq, socket, packet, address) of the delayed packets
+        self.__seq = 0
+        self.__selector = selectors.DefaultSelector()
+        self.__stopped = threading.Event()
+        self.__thread = None
+
+        self.__forwarded = 0
+        self.__dropped = 0
+        self.__duplicated = 0
+        self.__reordered = 0
+
+
+    @property
+    def Port(self):
+        return self.__sock.getsockname()[1]
+
+    @property
+    def Stats(self):
+        return {'forwarded': self.__forwarded, 'dropped': self.__dropped,
+                'duplicated': self.__duplicated, 'reordered': self.__reordered}
+
+
+    def start(self):
+        self.__selector.register(self.__sock, selectors.EVENT_READ, None)
+        self.__thread = threading.Thread(target=self.run, daemon=True)
+        self.__thread.start()
+
+
+    def stop(self):
+        self.__stopped.set()
+        self.__thread.join()
+        for sock in self.__upstreams.values():
+            sock.close()
+        self.__sock.close()
+        self.__selector.close()
+
+
+    def run(self):
+        while not self.__stopped.is_set():
+            timeout = 0.05 # check stop
+            if self.__queue:
+                timeout = min(max(self.__queue[0][0] - time.monotonic(), 0), timeout)
+
+            for key, events in self.__selector.select(timeout):
+                sock = key.fileobj
+                packet, addr = sock.recvfrom(65536)
+                if sock is self.__sock:
+                    # client -> server
+                    upstream = self.__upstreams.get(addr)
+                    if upstream is None:
+                        upstream = self.__upstreams[addr] = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                        upstream.bind(('127.0.0.1', 0))
+                        self.__servers[addr] = self.__server_addr
+                        self.__selector.register(upstream, selectors.EVENT_READ, addr)
+                    if TFTP.get_opcode(packet) in (TFTP.RRQ_OPCODE, TFTP.WRQ_OPCODE):
+                        # a retransmitted request goes to the TFTP port, not to the transfer's
+                        self.impair(upstream, packet, self.__server_addr)
+                    else:
+                        self.impair(upstream, packet, self.__servers[addr])
+                else:
+                    # server -> client, the next packets of the client go to the transfer's port.
+                    # The client sees a single address, the packets from another port than the
+                    # first answer are dropped like the client would reject them (unknown TID)
+                    if self.__servers[key.data] == self.__server_addr:
+                        self.__servers[key.data] = addr
+                    elif self.__servers[key.data] != addr:
+                        continue
+                    self.impair(self.__sock, packet, key.data)
+
+            now = time.monotonic()
+            while self.__queue and self.__queue[0][0] <= now:
+                due, seq, sock, packet, addr = heapq.heappop(self.__queue)
+                sock.sendto(packet, addr)
+
+
+    def impair(self, sock, packet, addr):
+        if self.__random.random() < self.__loss:
+            self.__dropped += 1
+            return
+
+        copies = 1
+        if self.__random.random() < self.__duplicate:
+            copies = 2
+            self.__duplicated += 1
+
+        for _ in range(copies):
+            delay = self.__delay + self.__random.uniform(0, self.__jitter)
+            if self.__random.random() < self.__reorder:
+                # held back, the next packets overtake it
+                delay += LossyProxy.REORDER_DELAY
+                self.__reordered += 1
+
+            self.__forwarded += 1
+            if delay <= 0:
+                sock.sendto(packet, addr)
+            else:
+                self.__seq += 1
+                heapq.heappush(self.__queue, (time.monotonic() + delay, self.__seq, sock, packet, addr))
+
+
+
+class Benchmark:
+    """ Run the server (server.py) in a child process on the loopback and drive concurrent
+        Client transfers against it, directly or through a LossyProxy. Every measured point
+        gets a new server process, its CPU time and peak RSS are taken when it exits """
+
+    def __init__(self, workdir, server_args=(), link=None, timeout=1, retries=5, windowsize=1, seed=0):
+        self.__server_dir = os.path.join(workdir, 'server')
+        self.__client_dir = os.path.join(workdir, 'client')
+        os.makedirs(self.__server_dir, exist_ok=True)
+        os.makedirs(self.__client_dir, exist_ok=True)
+        self.__server_args = list(server_args)
+        self.__link = link # LossyProxy options, None - no proxy
+        self.__timeout = timeout
+        self.__retries = retries
+        self.__windowsize = windowsize
+        self.__seed = seed
+
+
+    def create_files(self, size):
+        # the same content on both sides, downloaded (get) and uploaded (put),
+        # return its name and digest (every transferred copy is checked against it)
+        name = f"src-{size}"
+        data = random.Random(size).randbytes(size)
+        for directory in (self.__server_dir, self.__client_dir):
+            with open(os.path.join(directory, name), 'wb') as f:
+                f.write(data)
+        return name, hashlib.sha256(data).digest()
+
+
+    @staticmethod
+    def same_content(path, size, digest):
+        # a completed transfer is only measured if the copy is intact (the lossy link
+        # duplicates and reorders the packets)
+        try:
+            if os.path.getsize(path) != size:
+                return False
+            sha = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    sha.update(chunk)
+            return sha.digest() == digest
+        except OSError:
+            return False
+
+
+    def start_server(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1] # a free port
+
+        process = subprocess.Popen([sys.executable, SERVER, '-p', str(port), '-c', self.__server_dir,
+                                    '--log-level', 'error'] + self.__server_args)
+        Benchmark.wait_server(port)
+        return process, port
+
+
+    @staticmethod
+    def wait_server(port, timeout=10):
+        # the server answers a request of a missing file once it is listening
+        probe = TFTP.pack_rq_header(TFTP.RRQ_OPCODE, '.probe', 'octet')
+        deadline = time.monotonic() + timeout
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(0.1)
+            while time.monotonic() < deadline:
+                sock.sendto(probe, ('127.0.0.1', port))
+                try:
+                    sock.recvfrom(1024)
+                    return
+                except (socket.timeout, ConnectionRefusedError):
+                    pass
+        raise RuntimeError("the server did not start")
+
+
+    @staticmethod
+    def stop_server(process):
+        # CPU seconds and peak RSS (KB) of the server process (with its waited workers)
+        process.send_signal(signal.SIGTERM)
+        pid, status, usage = os.wait4(process.pid, 0)
+        process.returncode = status
+        return usage.ru_utime + usage.ru_stime, usage.ru_maxrss
+
+
+    def run_point(self, op, size, blksize, concurrency, transfers):
+        """ concurrency clients each run transfers transfers one after the other,
+            return the measured point as a dict """
+
+        name, digest = self.create_files(size)
+        process, port = self.start_server()
+        proxy = None
+        if self.__link is not None:
+            proxy = LossyProxy(('127.0.0.1', port), seed=self.__seed, **self.__link)
+            proxy.start()
+            port = proxy.Port
+
+        durations = []
+        failures = [0]
+        lock = threading.Lock()
+
+        def run_client(index):
+            for n in range(transfers):
+                if op == 'get':
+                    filename, target = name, f"get-{index}-{n}"
+                else:
+                    # the uploaded file has the name of the local one on the server
+                    filename = target = f"put-{size}-{blksize}-{concurrency}-{index}-{n}"
+                    os.link(name, filename)
+
+                client = Client('127.0.0.1', port, op, filename, target, self.__timeout, blksize, 1024,
+                                TFTP.TRANSFER_MODES[1], False, self.__windowsize, self.__retries)
+                start = time.monotonic()
+                ok = client.handle_request()
+                elapsed = time.monotonic() - start
+                # the copy is the local target (get) or the uploaded file on the server (put)
+                copy = target if op == 'get' else os.path.join(self.__server_dir, target)
+                ok = ok and Benchmark.same_content(copy, size, digest)
+                if os.path.exists(target):
+                    os.remove(target)
+                if op == 'put' and os.path.exists(copy):
+                    os.remove(copy)
+                with lock:
+                    if ok:
+                        durations.append(elapsed)
+                    else:
+                        failures[0] += 1
+
+        cwd = os.getcwd()
+        os.chdir(self.__client_dir) # the clients use names relative to their directory
+        try:
+            cpu_start = time.process_time()
+            start = time.monotonic()
+            threads = [threading.Thread(target=run_client, args=(index,)) for index in range(concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            wall = time.monotonic() - start
+            client_cpu = time.process_time() - cpu_start
+        finally:
+            os.chdir(cwd)
+            if proxy is not None:
+                proxy.stop()
+            server_cpu, server_rss = Benchmark.stop_server(process)
+
+        for entry in os.listdir(self.__server_dir):
+            if entry.startswith('put-'):
+                os.remove(os.path.join(self.__server_dir, entry))
+
+        durations.sort()
+        return {
+            'op': op, 'size': size, 'blksize': blksize, 'concurrency': concurrency,
+            'windowsize': self.__windowsize, 'transfers': concurrency * transfers, 'failures': failures[0],
+            'wall_seconds': wall,
+            'mb_per_second': len(durations) * size / wall / 1e6,
+            'p50_seconds': percentile(durations, 50),
+            'p99_seconds': percentile(durations, 99),
+            'mean_seconds': sum(durations) / len(durations) if durations else None,
+            'server_cpu_seconds': server_cpu,
+            'server_max_rss_kb': server_rss,
+            'client_cpu_seconds': client_cpu,
+            'link': proxy.Stats if proxy is not None else None,
+        }
+
+
+
+def percentile(values, p):
+    # nearest-rank percentile of sorted values
+    if not values:
+        return None
+    return values[max(0, -(-len(values) * p // 100) - 1)]
+
+
+def parse_size(text):
+    units = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+    text = text.strip().lower()
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def version():
+    # the commit being measured, to compare the results between versions
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                                cwd=os.path.dirname(SERVER), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    # print the change of the throughput and p99 against the same points of a previous run
+    previous = {(r['op'], r['size'], r['blksize'], r['concurrency'], r['windowsize']): r for r in baseline['results']}
+    print(f"\nCompared to {baseline.get('version')}:")
+    for r in results:
+        old = previous.get((r['op'], r['size'], r['blksize'], r['concurrency'], r['windowsize']))
+        if old is None or not old['mb_per_second'] or not old['p99_seconds'] or r['p99_seconds'] is None:
+            continue
+        print(f"{r['op']:4} size={r['size']:<10} blksize={r['blksize']:<6} concurrency={r['concurrency']:<4} "
+                f"MB/s {100 * (r['mb_per_second'] / old['mb_per_second'] - 1):+.1f}%  "
+                f"p99 {100 * (r['p99_seconds'] / old['p99_seconds'] - 1):+.1f}%")
+
+
+def main():
+    # Configuring arguments parser
+    parser = argparse.ArgumentParser(description='Benchmark the TFTP server on the loopback')
+    parser.add_argument('--ops', type=str, default='get,put', help='transfers to measure (default, get,put)')
+    parser.add_argument('--sizes', type=str, default='1k,1m,16m', help='file sizes (k, m, g suffixes)')
+    parser.add_argument('--blksizes', type=str, default='512,1428,8192', help='block sizes')
+    parser.add_argument('--concurrency', type=str, default='1,8,32', help='concurrent clients')
+    parser.add_argument('--transfers', type=int, default=4, help='transfers run by each client (default, 4)')
+    parser.add_argument('-w', '--windowsize', dest='windowsize', type=int, default=1, help='windowsize of the clients')
+    parser.add_argument('-t', '--timeout', dest='timeout', type=int, default=1, help='timeout of the clients')
+    parser.add_argument('-r', '--retries', dest='retries', type=int, default=5, help='retries of the clients')
+    parser.add_argument('--server-args', dest='server_args', type=str, default='',
+                            help='extra server.py arguments, like "-e asyncio -w 4"')
+    parser.add_argument('--delay', type=float, default=0, help='one way delay of the emulated link in ms (enables the proxy)')
+    parser.add_argument('--jitter', type=float, default=0, help='random extra delay up to jitter ms')
+    parser.add_argument('--loss', type=float, default=0, help='probability of a packet loss (0-1)')
+    parser.add_argument('--duplicate', type=float, default=0, help='probability of a packet duplication (0-1)')
+    parser.add_argument('--reorder', type=float, default=0, help='probability of a packet reordering (0-1)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the emulated link')
+    parser.add_argument('-o', '--output', type=str, default='bench-results.json', help='JSON file of the results')
+    parser.add_argument('--baseline', type=str, default=None, help='JSON results of a previous run to compare with')
+
+    args = parser.parse_args()
+
+    link = None
+    if args.delay or args.jitter or args.loss or args.duplicate or args.reorder:
+        link = dict(delay=args.delay / 1000, jitter=args.jitter / 1000, loss=args.loss,
+                    duplicate=args.duplicate, reorder=args.reorder)
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix='tftp-bench-') as workdir:
+        bench = Benchmark(workdir, args.server_args.split(), link, args.timeout, args.retries, args.windowsize, args.seed)
+        for op in args.ops.split(','):
+            for size in map(parse_size, args.sizes.split(',')):
+                for blksize in map(int, args.blksizes.split(',')):
+                    for concurrency in map(int, args.concurrency.split(',')):
+                        r = bench.run_point(op, size, blksize, concurrency, args.transfers)
+                        results.append(r)
+                        print(f"{op:4} size={size:<10} blksize={blksize:<6} concurrency={concurrency:<4} "
+                                f"{r['mb_per_second']:8.2f} MB/s  p50 {r['p50_seconds'] or 0:.4f}s  "
+                                f"p99 {r['p99_seconds'] or 0:.4f}s  failures {r['failures']}  "
+                                f"server cpu {r['server_cpu_seconds']:.2f}s rss {r['server_max_rss_kb']} KB")
+
+    report = {'version': version(), 'time': time.time(), 'python': platform.python_version(),
+                'platform': platform.platform(), 'settings': vars(args), 'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results are written to ({args.output})")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
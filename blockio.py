@@ -0,0 +1,194 @@
+import mmap
+import os
+
+
+class BlockReader:
+    """ Per-transfer sequential block reader.
+        The file is opened once for the whole transfer and the blocks are streamed
+        from a buffered handle, a seek is only needed when a block is requested
+        out of order (retransmission of an already sent block) """
+
+    # default read-ahead buffer of the underlying file object
+    READ_AHEAD = 64 * 1024
+
+    def __init__(self, filename, blksize, read_ahead=READ_AHEAD, cache=None, use_mmap=False, offset=0, length=None,
+                    prefetcher=None):
+        self.__filename = filename
+        self.__blksize = blksize
+        # the blocks are read from the range of the file that starts at offset 
+        # (the range option), length None - up to the end of the file
+        self.__offset = offset
+        self.__end = None if length is None else offset + length
+        # the buffer size of the BufferedReader is the read-ahead: one read syscall
+        # fills it and the next blocks are served from memory
+        self.__file = open(filename, 'rb', buffering=max(read_ahead, blksize))
+        self.__next_block = 1 # the block a sequential read returns next
+        if offset:
+            self.__file.seek(offset, os.SEEK_SET)
+
+        # the blocks of a file that fits the shared BlockCache are read from it
+        self.__cache = None
+        if cache is not None:
+            self.__identity = cache.identity(self.__file.fileno())
+            if cache.fits(self.__identity[1]):
+                self.__cache = cache
+
+        # otherwise the blocks may be memoryview slices of the mapped file (zero-copy),
+        # the file must not be truncated while it is mapped (SIGBUS)
+        self.__map = None
+        if self.__cache is None and use_mmap and os.fstat(self.__file.fileno()).st_size > 0:
+            self.__map = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(self.__map, 'madvise'):
+                self.__map.madvise(mmap.MADV_SEQUENTIAL)
+            self.__view = memoryview(self.__map)
+
+        # or the next blocks are read in the background by the Prefetcher (cold files)
+        self.__ahead = None
+        if self.__cache is None and self.__map is None and prefetcher is not None:
+            self.__ahead = prefetcher.open(self.__file.fileno(), blksize, offset, self.__end)
+
+
+    @property
+    def Filename(self):
+        return self.__filename
+
+    @property
+    def BlckSize(self):
+        return self.__blksize
+
+
+    def read_block(self, block_no):
+        """ Return the data of the given block (1-based), the last block
+            of the file (or of the range) is shorter than the block size (maybe empty) """
+
+        offset = self.__offset + (block_no - 1) * self.__blksize
+        size = self.__blksize
+        if self.__end is not None:
+            size = max(min(size, self.__end - offset), 0)
+
+        if self.__cache is not None:
+            return self.__cache.read(self.__filename, self.__identity, self.__file.fileno(), offset, size)
+
+        if self.__map is not None:
+            return self.__view[offset:offset + size]
+
+        if self.__ahead is not None:
+            return self.__ahead.read(offset, size)
+
+        if block_no != self.__next_block:
+            # retransmission - move back to the block position, seeking inside
+            # the read-ahead buffer does not touch the disk
+            self.__file.seek(offset, os.SEEK_SET)
+
+        content = self.__file.read(size)
+        self.__next_block = block_no + 1
+        return content
+
+
+    def close(self):
+        if self.__ahead is not None:
+            self.__ahead.close()
+        if self.__map is not None:
+            try:
+                self.__view.release()
+                self.__map.close()
+            except BufferError:
+                pass # a block is still referenced, the map is closed once it's released
+        self.__file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class BlockWriter:
+    """ Per-transfer write-behind block writer.
+        The target is kept open for the whole transfer and the received blocks
+        are coalesced in a large buffer, so the disk sees few big writes and not
+        one small write per DATA packet. Data is flushed (and optionally fsynced)
+        only when the writer is closed - on the last block or on error """
+
+    # default write-behind buffer of the underlying file object
+    WRITE_BEHIND = 1024 * 1024
+
+    def __init__(self, filename, blksize, write_behind=WRITE_BEHIND, fsync=False, size=None, offset=None):
+        self.__filename = filename
+        self.__blksize = blksize
+        self.__fsync = fsync
+        # a range of the file (a stripe or a resumed get) is written into the existing
+        # file from offset, None - the file is created (or truncated)
+        self.__offset = offset or 0
+        if offset is None:
+            self.__file = open(filename, 'wb', buffering=max(write_behind, blksize))
+        else:
+            self.__file = open(filename, 'r+b', buffering=max(write_behind, blksize))
+            self.__file.seek(offset, os.SEEK_SET)
+        self.__next_block = 1 # the block expected to be written next
+        self.__length = 0 # bytes written so far
+        self.__preallocated = False
+
+        if size:
+            self.preallocate(size)
+
+
+    @property
+    def Filename(self):
+        return self.__filename
+
+    @property
+    def BlckSize(self):
+        return self.__blksize
+
+    @property
+    def Length(self):
+        return self.__length
+
+
+    def preallocate(self, size):
+        """ Reserve the disk space of the whole file when its size is known,
+            so the filesystem can lay it out in one extent """
+
+        if not hasattr(os, 'posix_fallocate'):
+            return
+        try:
+            os.posix_fallocate(self.__file.fileno(), 0, size)
+            self.__preallocated = True
+        except OSError:
+            # not supported by the filesystem, the file just grows while writing
+            pass
+
+
+    def write_block(self, block_no, data):
+        """ Append the data of the given block (1-based),
+            return False if the block is a duplicate that was already written """
+
+        if block_no != self.__next_block:
+            return False
+
+        self.__file.write(data)
+        self.__next_block = block_no + 1
+        self.__length += len(data)
+        return True
+
+
+    def close(self):
+        if self.__file.closed:
+            return
+
+        try:
+            self.__file.flush()
+            if self.__preallocated:
+                # drop the reserved space that has not been written
+                self.__file.truncate(self.__offset + self.__length)
+            if self.__fsync:
+                os.fsync(self.__file.fileno())
+        finally:
+            self.__file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
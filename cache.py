@@ -0,0 +1,129 @@
+import os
+import threading
+from collections import OrderedDict
+
+
+class BlockCache:
+    """ Server-wide in-memory cache of file chunks shared by all the RRQ transfers.
+        Concurrent readers of a hot file share one copy of its chunks, the least
+        recently used chunks are evicted once the memory budget is exceeded and a chunk
+        is reloaded when the file's identity (mtime, size, inode) changed """
+
+    CHUNK_SIZE = 256 * 1024
+
+    def __init__(self, budget, chunk_size=CHUNK_SIZE):
+        self.__budget = budget # bytes
+        self.__chunk_size = chunk_size
+        self.__size = 0 # bytes held by the cache
+        self.__chunks = OrderedDict() # (filename, chunk_no): (identity, data), in LRU order
+        self.__loading = {} # (filename, chunk_no): Event, chunks being read from the disk
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__misses = 0
+
+
+    @property
+    def Budget(self):
+        return self.__budget
+
+    @property
+    def Size(self):
+        return self.__size
+
+    @property
+    def Hits(self):
+        return self.__hits
+
+    @property
+    def Misses(self):
+        return self.__misses
+
+
+    @staticmethod
+    def identity(fd):
+        # a chunk cached for another version of the file is stale
+        st = os.fstat(fd)
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+    def invalidate(self, filename):
+        # drop the chunks of a file that changed (or was removed), their memory is
+        # given back now and not once they are the least recently used
+        with self.__lock:
+            for key in [key for key in self.__chunks if key[0] == filename]:
+                self.__size -= len(self.__chunks.pop(key)[1])
+
+
+    def fits(self, size):
+        # a file larger than the budget would only evict itself (and the hot files)
+        return 0 < size <= self.__budget
+
+
+    def read(self, filename, identity, fd, offset, size):
+        """ Return size bytes from offset of the file (shorter at the end of the file) as a memoryview,
+            the chunks are read once from the file descriptor fd on a miss """
+
+        parts = []
+        while size > 0:
+            chunk_no, start = divmod(offset, self.__chunk_size)
+            chunk = self.get_chunk(filename, identity, fd, chunk_no)
+            # a memoryview of the shared chunk, the block is not copied
+            data = memoryview(chunk)[start:start + size]
+            if not data:
+                break # end of file
+
+            parts.append(data)
+            offset += len(data)
+            size -= len(data)
+            if len(chunk) < self.__chunk_size:
+                break # last chunk of the file
+
+        if len(parts) == 1:
+            return parts[0]
+        # the block spans two chunks (or it's the empty last block)
+        return b''.join(parts)
+
+
+    def get_chunk(self, filename, identity, fd, chunk_no):
+        key = (filename, chunk_no)
+
+        while True:
+            with self.__lock:
+                entry = self.__chunks.get(key)
+                if entry is not None and entry[0] == identity:
+                    self.__chunks.move_to_end(key)
+                    self.__hits += 1
+                    return entry[1]
+
+                event = self.__loading.get(key)
+                if event is None:
+                    # this reader loads the chunk, the others wait for it
+                    event = self.__loading[key] = threading.Event()
+                    self.__misses += 1
+                    break
+
+            event.wait()
+
+        try:
+            data = os.pread(fd, self.__chunk_size, chunk_no * self.__chunk_size)
+            with self.__lock:
+                self.__store(key, identity, data)
+            return data
+        finally:
+            with self.__lock:
+                del self.__loading[key]
+            event.set()
+
+
+    def __store(self, key, identity, data):
+        entry = self.__chunks.pop(key, None)
+        if entry is not None:
+            self.__size -= len(entry[1]) # a stale version of the chunk
+
+        self.__chunks[key] = (identity, data)
+        self.__size += len(data)
+
+        while self.__size > self.__budget and self.__chunks:
+            key, (identity, data) = self.__chunks.popitem(last=False)
+            self.__size -= len(data)
+
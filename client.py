@@ -1,12 +1,20 @@
 #!/usr/bin/env python3
 import socket
+import time
 import os
 import argparse
-from tftp import TFTP
+import threading
+from tftp import TFTP, Transfer, RttEstimator
+from blockio import BlockReader, BlockWriter
+from netascii import NetasciiReader, NetasciiWriter
+from multicast import MulticastClient
+from compress import CODECS, CompressingReader, CompressedWriter
+from logger import log, setup_logging, transfer_summary
 
 class Client(TFTP):
 
-    def __init__(self, ip, port, request_mod, filename, targetname, timeout, blksize, buffer_size, transfer_mode, is_logging):
+    def __init__(self, ip, port, request_mod, filename, targetname, timeout, blksize, buffer_size, transfer_mode, is_logging,
+                    windowsize=1, retries=5, byte_range=None, compress=False):
         super().__init__(blksize, transfer_mode)
         self.__ip = ip
         self.__port = port # TFTP Protocol Port (69)
@@ -16,56 +24,339 @@ class Client(TFTP):
         self.__timeout = timeout # timeout to waiting for the client
         self.__buffer_size = buffer_size
         self.__is_logging = is_logging # verbose messages  
+        self.__windowsize = windowsize # blocks in flight (RFC 7440)
+        self.__retries = retries # retransmissions before giving up on the server
+        self.__transfer = None # created by the reply of the server
+        self.__error = None # why the transfer failed
+        # (offset, length) of the file to get (the range option), length None - up to the end
+        # of the file (a resumed get, the whole file is got if the server ignores the option)
+        self.__range = byte_range
+        self.__tsize = None # the size of the file told by the server
+        self.__compress = compress # offer the codecs of the compress option (octet mode)
+
+
+    def request_options(self):
+        """ Options sent with the RRQ/WRQ request (RFC 2347) """
+
+        options = {}
+        if self.BlckSize != TFTP.DEFAULT_BLKSIZE:
+            options[TFTP.OPT_BLKSIZE] = self.BlckSize
+
+        if self.__windowsize > 1:
+            options[TFTP.OPT_WINDOWSIZE] = self.__windowsize
+
+        if isinstance(self.__timeout, int) and TFTP.MIN_TIMEOUT <= self.__timeout <= TFTP.MAX_TIMEOUT:
+            options[TFTP.OPT_TIMEOUT] = self.__timeout
+
+        # ask the size of the file on get, tell it on put
+        options[TFTP.OPT_TSIZE] = 0 if self.__request_mod == "get" else os.path.getsize(self.__filename)
+
+        if self.__range is not None and self.__request_mod == "get" and self.TransferMode == TFTP.TRANSFER_MODES[1]:
+            offset, length = self.__range
+            options[TFTP.OPT_RANGE] = f"{offset}:{'' if length is None else length}"
+        elif self.__compress and self.TransferMode == TFTP.TRANSFER_MODES[1]:
+            # the offsets of a range are in the file, a range is not compressed
+            options[TFTP.OPT_COMPRESS] = ','.join(CODECS)
+        return options
+
+
+    def range_required(self):
+        # a stripe of a striped get can't fall back to the whole file
+        return self.__range is not None and self.__range[1] is not None
+
+
+    def accept_oack(self, requested, options):
+        """ Return True if the server acknowledged only requested options with valid values,
+            the block and window sizes may only be lowered by the server """
+
+        if not TFTP.check_options(options):
+            return False
+
+        for name in options:
+            if name not in requested:
+                return False
+
+        if int(options.get(TFTP.OPT_BLKSIZE, TFTP.DEFAULT_BLKSIZE)) > self.BlckSize:
+            return False
+
+        if int(options.get(TFTP.OPT_WINDOWSIZE, 1)) > self.__windowsize:
+            return False
+
+        if TFTP.OPT_RANGE in options:
+            # the range starts at the requested offset, it's maybe cut at the end of the file
+            offset, length = TFTP.parse_range(options[TFTP.OPT_RANGE])
+            if offset != self.__range[0] or length is None or \
+                    (self.__range[1] is not None and length > self.__range[1]):
+                return False
+        elif self.range_required():
+            return False
+
+        if TFTP.OPT_COMPRESS in options and options[TFTP.OPT_COMPRESS] not in CODECS:
+            return False
+
+        return True
+
+
+    def request_packet(self, options):
+        # the RRQ names the file on the server, the WRQ names the target on the server
+        if self.__request_mod == "get":
+            return self.pack_rq_header(TFTP.RRQ_OPCODE, self.__filename, self.TransferMode, options)
+        return self.pack_rq_header(TFTP.WRQ_OPCODE, self.__targetname, self.TransferMode, options)
+
+
+    @property
+    def ActiveTransfer(self):
+        return self.__transfer
+
+    @property
+    def Error(self):
+        return self.__error
+
+    @property
+    def Tsize(self):
+        return self.__tsize
+
+
+    def send_request(self, sock):
+        """ Send the RRQ/WRQ request, the transfer is created by the server's reply """
+
+        self.__options = self.request_options()
+        self.__request = self.request_packet(self.__options)
+        TFTP.send_packet(self.__request, sock, (self.__ip, self.__port))
+
+        # the reply to the request is the first RTT sample of the transfer
+        self.__rtt = RttEstimator(self.__timeout, self.__timeout)
+        self.__request_sent = time.monotonic()
+        self.__request_retries = 0
+        self.__server_addr = None # the port (TID) of the server's transfer
+        self.__transfer = None
+        self.__error = None
+
+
+    def wait_time(self):
+        # time until the retransmission timer expires
+        return self.__transfer.timeout() if self.__transfer else self.__rtt.Rto
+
+
+    def create_transfer(self, accepted=None):
+        """ The transfer with the options accepted by the server's OACK, 
+            None - the server ignored the options, transfer with the defaults """
+
+        windowsize, timeout, tsize, offset, codec = 1, self.__timeout, None, None, None
+        self.BlckSize = TFTP.DEFAULT_BLKSIZE
+        if accepted is not None:
+            self.BlckSize = int(accepted.get(TFTP.OPT_BLKSIZE, TFTP.DEFAULT_BLKSIZE))
+            timeout = int(accepted.get(TFTP.OPT_TIMEOUT, self.__timeout))
+            if TFTP.OPT_TSIZE in accepted:
+                tsize = self.__tsize = int(accepted[TFTP.OPT_TSIZE])
+            windowsize = int(accepted.get(TFTP.OPT_WINDOWSIZE, 1))
+            if TFTP.OPT_RANGE in accepted:
+                # write the range into the existing target, the striped get preallocated it
+                offset = TFTP.parse_range(accepted[TFTP.OPT_RANGE])[0]
+                if self.range_required():
+                    tsize = None
+            codec = accepted.get(TFTP.OPT_COMPRESS)
+
+        if self.TransferMode == TFTP.TRANSFER_MODES[0]:
+            # the line ends are translated while the blocks are streamed
+            if self.__request_mod == "get":
+                stream = NetasciiWriter(self.__targetname, self.BlckSize, size=tsize)
+            else:
+                stream = NetasciiReader(self.__filename, self.BlckSize)
+        elif codec is not None:
+            # the blocks are compressed data, (de)compressed while they are streamed
+            if self.__request_mod == "get":
+                stream = CompressedWriter(self.__targetname, self.BlckSize, codec, size=tsize)
+            else:
+                stream = CompressingReader(self.__filename, self.BlckSize, codec, windowsize=windowsize)
+        elif self.__request_mod == "get":
+            stream = BlockWriter(self.__targetname, self.BlckSize, size=tsize, offset=offset)
+        else:
+            # open the local file once for the whole upload
+            stream = BlockReader(self.__filename, self.BlckSize)
+        return Transfer(stream, windowsize, timeout, self.__retries, self.__rtt)
+
+
+    def handle_timeout(self, sock):
+        """ Resend the last packet (or the request), return False once the retry budget is spent """
+
+        if self.__transfer is not None:
+            if self.retransmit(self.__transfer, sock, self.__server_addr, self.TransferMode):
+                return True
+        elif self.__request_retries < self.__retries:
+            self.__request_retries += 1
+            self.__rtt.backoff()
+            TFTP.send_packet(self.__request, sock, (self.__ip, self.__port))
+            return True
+
+        log.warning("Connection timeouts")
+        self.__error = "Connection timeouts"
+        return False
+
+
+    def handle_packet(self, packet_req, addr, sock):
+        """ Handle a reply of the server, shared by the blocking and the batch (asyncio) clients
+            return True to wait for more packets, otherwise False to finalize the transfer """
+
+        if self.__server_addr is None:
+            self.__server_addr = addr
+            if self.__request_retries == 0:
+                self.__rtt.sample(time.monotonic() - self.__request_sent)
+
+        elif addr != self.__server_addr:
+            # a packet from another port, the transfer goes on
+            TFTP.send_packet(TFTP.pack_error(5), sock, addr) # 'Unknown Transfer TID' ERROR 
+            return True
+
+        opcode = TFTP.get_opcode(packet_req)
+
+        if opcode == TFTP.ERR_OPCODE: # an error occured 
+            # parse error message
+            opcode, error_code, error_msg = self.unpack_error(packet_req)
+            log.error("[Server Reply]: Error Message: %s, ERROR_CODE: (%s)", error_msg, error_code)            
+            self.__error = f"{error_msg} ({error_code})"
+            return False
+
+        elif opcode == TFTP.OACK_OPCODE: # the server accepted (some of) the requested options
+            if self.__transfer is not None:
+                return True # a retransmitted OACK, our answer is retransmitted by the timer
+
+            opcode, accepted = self.unpack_oack(packet_req)
+            log.info("[GET OACK]: (%s) options(%s)", addr, accepted)
+
+            if not self.accept_oack(self.__options, accepted):
+                TFTP.send_packet(TFTP.pack_error(8), sock, addr) # 'Option Negotiation Failed' ERROR
+                self.__error = TFTP.TFTP_ERRORS[8]
+                return False
+
+            self.__transfer = self.create_transfer(accepted)
+            if self.__request_mod == "get":
+                # acknowledge the options by ACK 0, then the server sends the first window
+                TFTP.fit_receive_buffer(sock, self.__transfer)
+                self.__transfer.last_packet = TFTP.pack_ack(0)
+                TFTP.send_packet(self.__transfer.last_packet, sock, addr)
+                self.__transfer.arm()
+            else:
+                # the OACK takes the place of ACK 0, send the first window
+                self.send_window(self.__transfer, sock, addr, self.TransferMode)
+            return True
+
+        elif opcode == TFTP.DAT_OPCODE and self.__request_mod == "get": # after sending RRQ
+            if self.__transfer is None and self.range_required():
+                # the server ignored the options, it sends the whole file
+                TFTP.send_packet(TFTP.pack_error(8), sock, addr) # 'Option Negotiation Failed' ERROR
+                self.__error = TFTP.TFTP_ERRORS[8]
+                return False
+            if self.__transfer is None:
+                # create the target only once the server started sending
+                self.__transfer = self.create_transfer()
+            return self.get_dat_send_ack(self.__transfer, packet_req, sock, addr)
+
+        elif opcode == TFTP.ACK_OPCODE and self.__request_mod == "put": # after sending WRQ
+            if self.__transfer is None:
+                self.__transfer = self.create_transfer()
+            return self.get_ack_send_dat(self.__transfer, packet_req, sock, addr, self.TransferMode)
+
+        TFTP.send_packet(TFTP.pack_error(4), sock, addr) # 'Illegal TFTP operation' ERROR
+        self.__error = TFTP.TFTP_ERRORS[4]
+        return False
+
+
+    def finish(self):
+        """ Close the transfer, return True if it completed """
+
+        if self.__transfer is None:
+            return False
+
+        self.__transfer.close()
+        if self.__is_logging:
+            transfer_summary(self.__transfer, self.__request_mod, self.__server_addr)
+        return self.__transfer.completed
 
 
     def handle_request(self):
+        """ Run the get/put transfer, return True if it completed """
 
+        sock = None
         try:  
 
             # Creating udp socket
             sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
-            sock.settimeout(self.__timeout)  # Setting socket to timeout
-            addr = (self.__ip, self.__port)
-
-            if self.__request_mod == "get":
-                request = self.pack_rq_header(TFTP.RRQ_OPCODE, self.__filename, self.TransferMode)
-            else: # put request
-                request = self.pack_rq_header(TFTP.WRQ_OPCODE, self.__filename, self.TransferMode)
+            self.send_request(sock)  # Sending TFTP RRQ/WRQ packet to server
+            # the DATA packets are as large as the (requested) block size, every packet 
+            # is received into this buffer
+            view = memoryview(bytearray(max(self.__buffer_size, self.BlckSize + 4)))
 
-            sock.sendto(request, addr)  # Sending TFTP RRQ packet to server
-
-            last_packet = None
             while True:
 
-                packet_req, addr = sock.recvfrom(self.__buffer_size)
-                opcode = TFTP.get_opcode(packet_req)
+                try:
+                    sock.settimeout(self.wait_time())
+                    packet_req, addr = TFTP.receive(sock, view)
 
-                if opcode == TFTP.ERR_OPCODE: # an error occured 
-                    # parse error message
-                    opcode, error_code, error_msg = self.unpack_error(packet_req)
-                    print(f"[Server Reply]: Error Message: {error_msg}, ERROR_CODE: ({error_code})")            
+                except socket.timeout:
+                    # resend the last packet, give up once the retry budget is spent 
+                    if self.handle_timeout(sock):
+                        continue
                     break
 
-                elif opcode == TFTP.DAT_OPCODE: # this is client read (get) request, after sending RRQ                
-                    last_packet = self.get_dat_send_ack(packet_req, self.__targetname, sock, addr)  
-                    if last_packet is None:
-                        break
-
-                elif opcode == TFTP.ACK_OPCODE: # this is client write (put) request (WRQ request)
-                    last_packet = self.get_ack_send_dat(last_packet, packet_req, self.__filename, sock, addr, self.TransferMode)
-                    if last_packet is None:
-                        break
+                if not self.handle_packet(packet_req, addr, sock):
+                    if self.__transfer is not None and self.__transfer.final_acked:
+                        self.dally(self.__transfer, sock, addr, view)
+                    break
 
-            
-            #self.check_get_put(result)
+        except Exception as e:
+            log.error("Error: %s", e)
+            self.__error = str(e)
 
+        finally:
             if not sock is None:
-                sock.close()  
+                sock.close()
 
+        try:
+            return self.finish()
         except Exception as e:
-            print("Error: ", e)
-            if not sock is None:
-                sock.close()    
+            # the flush of the written data failed (like a full disk)
+            log.error("Error: %s", e)
+            self.__error = str(e)
+            return False
+
+
+
+def striped_get(ip, port, filename, targetname, stripes, timeout, blksize, windowsize=1, retries=5, is_logging=True):
+    """ Get the file in `stripes` ranges over parallel transfers (the range option), every
+        transfer writes its range into the preallocated target at its offset.
+        Return True if all the ranges completed """
+
+    # the first transfer gets an empty range, only the size of the file
+    open(targetname, 'wb').close()
+    probe = Client(ip, port, "get", filename, targetname, timeout, blksize, 1024, TFTP.TRANSFER_MODES[1], False,
+                    windowsize, retries, (0, 0))
+    if not probe.handle_request() or probe.Tsize is None:
+        return False
+
+    size = probe.Tsize
+    with open(targetname, 'r+b') as f:
+        f.truncate(size)
+        if hasattr(os, 'posix_fallocate') and size:
+            try:
+                os.posix_fallocate(f.fileno(), 0, size)
+            except OSError:
+                pass # not supported by the filesystem
+
+    stripe = max(-(-size // stripes), 1)
+    clients = [Client(ip, port, "get", filename, targetname, timeout, blksize, 1024, TFTP.TRANSFER_MODES[1], is_logging,
+                        windowsize, retries, (offset, min(stripe, size - offset))) for offset in range(0, size, stripe)]
+    results = [False] * len(clients)
+
+    def run(index):
+        results[index] = clients[index].handle_request()
+
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(len(clients))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return all(results)
 
 
 
@@ -74,8 +365,13 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-p', '--port', dest='port', type=int,  default=69, help='server port')
     parser.add_argument('-t', "--timeout", dest='timeout', type=int, default=3, help="timeout to close the connection")
+    parser.add_argument('-r', "--retries", dest='retries', type=int, default=5, help="retransmissions of a packet before closing the connection")
     parser.add_argument('-c', '--cwd', dest='cwd', type=str, default='', help='Change the current directory in which the files (with relative paths) are read or written')
     parser.add_argument('-b', '--blksize', dest='blksize', type=int, default=512, help='indicates the size in bytes of the data block used to transfer files (default, 512).')
+    parser.add_argument('-w', '--windowsize', dest='windowsize', type=int, default=1, help='number of blocks sent before waiting for an ACK (default, 1 - lock-step).')
+    parser.add_argument('--log-level', dest='log_level', choices=['debug', 'info', 'warning', 'error'], default='info', help='messages logged (info - a summary of the transfer)')
+    parser.add_argument('--trace-packets', dest='trace_packets', type=int, default=0, metavar='N', help='log 1 of every N packets (default, 0 - no per-packet logs)')
+    parser.add_argument('--trace-file', dest='trace_file', type=str, default=None, help='write every packet as a JSON line to this file')
 
     subparsers = parser.add_subparsers(dest='cmd')
     subparsers.add_parser('get', help="get file from server")
@@ -83,10 +379,21 @@ def main():
 
     parser.add_argument('host', type=str, default='127.0.0.1', help='Hostname')
     parser.add_argument('filename', type=str, default='', help='Filename')
-    parser.add_argument('-n', '--targetname' , type=str, default='', help="Targetname")
+    parser.add_argument('-n', '--targetname' , type=str, default='', help="Targetname (the local file of get, the file on the server of put)")
+    parser.add_argument('-s', '--stripes', dest='stripes', type=int, default=1, help='get the file in N ranges over parallel transfers (default, 1)')
+    parser.add_argument('--resume', dest='resume', action='store_true', help='continue the get of a partial target from its size')
+    parser.add_argument('-m', '--mode', dest='mode', choices=TFTP.TRANSFER_MODES[:2], default=TFTP.TRANSFER_MODES[1], 
+                            help='transfer mode, netascii translates the line ends (default, octet)')
+    parser.add_argument('--multicast', dest='multicast', action='store_true', 
+                            help='get the file from the multicast group of the server with the other clients asking it (RFC 2090)')
+    parser.add_argument('--multicast-if', dest='multicast_if', type=str, default=None, metavar='ADDR', 
+                            help='address of the interface receiving the group (default, the one routing to the server)')
+    parser.add_argument('-z', '--compress', dest='compress', action='store_true', 
+                            help='transfer the file compressed if the server acknowledges the compress option (octet mode)')
 
 
     args = parser.parse_args()
+    setup_logging(args.log_level, args.trace_packets, args.trace_file)
 
     # change target filename
     if args.targetname == '': 
@@ -96,19 +403,38 @@ def main():
     if args.cwd != '': 
         os.chdir(args.cwd)
 
+    # multicast get request, it fails if the server doesn't acknowledge the multicast option
+    if args.cmd == 'get' and args.multicast:
+        client = MulticastClient(args.host, args.port, args.filename, args.targetname, args.timeout, args.blksize, 
+                                    1024, True, args.windowsize, args.retries, args.multicast_if)
+        if not client.handle_request():
+            log.error("Multicast get of (%s) failed: %s", args.filename, client.Error)
+        return
+
+    # striped get request (the ranges are offsets of the octet file)
+    if args.cmd == 'get' and args.stripes > 1 and args.mode == TFTP.TRANSFER_MODES[1]:
+        if not striped_get(args.host, args.port, args.filename, args.targetname, args.stripes, args.timeout, 
+                            args.blksize, args.windowsize, args.retries):
+            log.error("Striped get of (%s) failed", args.filename)
+        return
+
     # get request
     if args.cmd == 'get':   
+        # a resumed get asks the rest of the file from the size of the partial target
+        byte_range = None
+        if args.resume and os.path.isfile(args.targetname):
+            byte_range = (os.path.getsize(args.targetname), None)
         client = Client(args.host, args.port, "get", args.filename, args.targetname, args.timeout, 
-                            args.blksize, 1024, TFTP.TRANSFER_MODES[1], True)
+                            args.blksize, 1024, args.mode, True, args.windowsize, args.retries, byte_range, args.compress)
     # put request
     if args.cmd == 'put':
         #  check if file exists:
         if not os.path.isfile(args.filename):
-            print(f"ERRORL you entered file does not exist in system folders")
+            log.error("ERROR you entered file does not exist in system folders")
             return
 
         client = Client(args.host, args.port, "put", args.filename, args.targetname, args.timeout, 
-                            args.blksize, 1024, TFTP.TRANSFER_MODES[1], True)
+                            args.blksize, 1024, args.mode, True, args.windowsize, args.retries, compress=args.compress)
 
     # os.chdir("/home/kamal/NetworkingProj/client_test")
     # client = Client("127.0.0.1", 6969, "put", "nature", "nature11", 3, 512, 1024, "octet", True)
@@ -0,0 +1,279 @@
+import threading
+import zlib
+from collections import OrderedDict
+from tftp import DataError
+from blockio import BlockWriter
+from cache import BlockCache
+
+
+# codec name: (compressor of a level, decompressor), in the order of preference, the
+# decompressor bounds its output (max_length) and keeps the rest of the input (unconsumed_tail)
+CODECS = OrderedDict()
+CODECS['zlib'] = (zlib.compressobj, zlib.decompressobj)
+
+LEVEL = 6
+
+
+def choose_codec(value):
+    """ Return the first codec of the option value (comma separated names, the
+        peer's preference) that is supported, None if there's none """
+
+    for name in value.split(','):
+        name = name.strip().lower()
+        if name in CODECS:
+            return name
+    return None
+
+
+
+class CompressedStream:
+    """ The compressed data of a version of a file, produced on demand: a read compresses
+        the file only up to the asked bytes, so the first DATA blocks are sent at once and
+        not after the whole file is compressed. A shared stream is read by all the
+        transfers of the file and kept whole (once complete its blocks are views of it),
+        a private stream drops the data behind the transfer's window """
+
+    READ_SIZE = 64 * 1024
+
+    def __init__(self, file, codec, level=LEVEL, shared=True):
+        self.__file = file # the source, closed once it's compressed
+        self.__identity = BlockCache.identity(file.fileno())
+        self.__compressor = CODECS[codec][0](level)
+        self.__shared = shared
+        self.__data = bytearray() # the compressed data so far (of a private stream, from base)
+        self.__base = 0
+        self.__complete = None # the whole compressed data once the file is compressed (shared)
+        self.__eof = False
+        self.__lock = threading.Lock()
+
+
+    @property
+    def Identity(self):
+        return self.__identity
+
+    @property
+    def Shared(self):
+        return self.__shared
+
+    @property
+    def Size(self):
+        # bytes held in memory
+        return len(self.__complete) if self.__complete is not None else len(self.__data)
+
+
+    def read(self, offset, size, keep_from=0):
+        """ Return size bytes from offset of the compressed data (shorter at its end),
+            a private stream may drop the data before keep_from """
+
+        with self.__lock:
+            # compressed by the reader that's ahead, the others find the data ready
+            while not self.__eof and self.__base + len(self.__data) < offset + size:
+                chunk = self.__file.read(CompressedStream.READ_SIZE)
+                if chunk:
+                    self.__data += self.__compressor.compress(chunk)
+                else:
+                    self.__data += self.__compressor.flush()
+                    self.__eof = True
+                    self.__file.close()
+                    if self.__shared:
+                        self.__complete, self.__data = bytes(self.__data), bytearray()
+
+            if self.__complete is not None:
+                # a view of the shared data, the block is not copied
+                return memoryview(self.__complete)[offset:offset + size]
+
+            # a copy, the buffer still grows (a view would pin it)
+            start = offset - self.__base
+            block = bytes(self.__data[start:start + size])
+            if not self.__shared and keep_from - self.__base >= CompressedStream.READ_SIZE:
+                del self.__data[:keep_from - self.__base]
+                self.__base = keep_from
+            return block
+
+
+    def close(self):
+        with self.__lock:
+            self.__file.close()
+
+
+
+class CompressedFiles:
+    """ Server-wide cache of the compressed versions of the hot files, so a file is
+        compressed once for all its clients and not once per transfer. A file that fits the
+        memory budget is compressed into a shared stream, the least recently used streams
+        are evicted once the budget is exceeded and a stream is compressed again when the
+        file's identity (mtime, size, inode) changed. A larger file is compressed by every
+        transfer on its own and only the blocks of its window are held """
+
+    def __init__(self, budget, level=LEVEL):
+        self.__budget = budget # bytes, 0 - no file is kept
+        self.__level = level
+        self.__streams = OrderedDict() # (filename, codec): CompressedStream, in LRU order
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__misses = 0
+
+
+    @property
+    def Size(self):
+        return sum(stream.Size for stream in self.__streams.values())
+
+    @property
+    def Hits(self):
+        return self.__hits
+
+    @property
+    def Misses(self):
+        return self.__misses
+
+
+    def fits(self, size):
+        return 0 < size <= self.__budget
+
+
+    def open(self, filename, codec):
+        """ Return the CompressedStream of the current version of the file """
+
+        file = open(filename, 'rb')
+        identity = BlockCache.identity(file.fileno())
+        if not self.fits(identity[1]):
+            return CompressedStream(file, codec, self.__level, shared=False)
+
+        key = (filename, codec)
+        with self.__lock:
+            stream = self.__streams.pop(key, None)
+            if stream is not None and stream.Identity == identity:
+                self.__hits += 1
+                file.close()
+            else:
+                self.__misses += 1
+                stream = CompressedStream(file, codec, self.__level)
+            self.__streams[key] = stream
+
+            # the readers of an evicted stream keep it until they end
+            size = self.Size
+            while size > self.__budget and len(self.__streams) > 1:
+                key, evicted = self.__streams.popitem(last=False)
+                size -= evicted.Size
+            return stream
+
+
+    def invalidate(self, filename):
+        # drop the compressed versions of a file that changed (or was removed)
+        with self.__lock:
+            for key in [key for key in self.__streams if key[0] == filename]:
+                del self.__streams[key]
+
+
+
+class CompressingReader:
+    """ Per-transfer block reader of a file sent compressed (the compress option), the
+        DATA blocks are blocks of the compressed data and the last one is short.
+        A retransmission goes back at most a window, a private stream keeps only that """
+
+    def __init__(self, filename, blksize, codec, files=None, windowsize=1):
+        self.__filename = filename
+        self.__blksize = blksize
+        if files is not None:
+            self.__stream = files.open(filename, codec)
+        else:
+            self.__stream = CompressedStream(open(filename, 'rb'), codec, shared=False)
+        self.__keep = windowsize * blksize
+
+
+    @property
+    def Filename(self):
+        return self.__filename
+
+    @property
+    def BlckSize(self):
+        return self.__blksize
+
+
+    def read_block(self, block_no):
+        """ Return the compressed data of the given block (1-based), the last block
+            is shorter than the block size (maybe empty) """
+
+        offset = (block_no - 1) * self.__blksize
+        return self.__stream.read(offset, self.__blksize, offset - self.__keep)
+
+
+    def close(self):
+        if not self.__stream.Shared:
+            self.__stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+
+class CompressedWriter:
+    """ Per-transfer block writer of a file received compressed, every block is
+        decompressed as it arrives (incrementally, a block at a time) and the
+        data is written by a BlockWriter. A block is decompressed in chunks of at most
+        CHUNK bytes, a small block of highly compressed data can't take a large buffer """
+
+    CHUNK = 256 * 1024
+
+    def __init__(self, filename, blksize, codec, write_behind=BlockWriter.WRITE_BEHIND, fsync=False, size=None):
+        self.__writer = BlockWriter(filename, blksize, write_behind, fsync, size)
+        self.__decompressor = CODECS[codec][1]()
+        self.__next_block = 1
+        self.__written = 0 # blocks given to the writer (the decompressed data of a block may be empty)
+
+
+    @property
+    def Filename(self):
+        return self.__writer.Filename
+
+    @property
+    def BlckSize(self):
+        return self.__writer.BlckSize
+
+    @property
+    def Length(self):
+        return self.__writer.Length
+
+
+    def write_block(self, block_no, data):
+        """ Decompress and append the data of the given block (1-based),
+            return False if the block is a duplicate that was already written """
+
+        if block_no != self.__next_block:
+            return False
+
+        try:
+            while data:
+                self.write(self.__decompressor.decompress(data, CompressedWriter.CHUNK))
+                data = self.__decompressor.unconsumed_tail
+        except zlib.error as e:
+            raise DataError(f"Corrupt compressed data (block {block_no})") from e
+
+        self.__next_block = block_no + 1
+        return True
+
+
+    def write(self, data):
+        if data:
+            self.__written += 1
+            self.__writer.write_block(self.__written, data)
+
+
+    def close(self):
+        # closed by the last block, and again by the end of the transfer
+        if self.__decompressor is None:
+            return
+        decompressor, self.__decompressor = self.__decompressor, None
+        try:
+            self.write(decompressor.flush())
+        finally:
+            self.__writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
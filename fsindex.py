@@ -0,0 +1,104 @@
+import os
+import stat
+import threading
+import time
+from logger import log
+
+
+class FileIndex:
+    """ In-memory index of the served directory: the size, mtime and inode of every regular
+        file, so a request is validated (and its tsize answered) without a stat call.
+        A background thread rescans the directory every interval seconds (polling, the
+        stand-in of a change notification), only the entries that changed are updated and
+        their cached blocks (and compressed versions) are dropped. The server's own changes
+        (the files created and written by WRQs) are applied at once, a name missing from the
+        index is looked up on the disk (a file added since the last scan) """
+
+    INTERVAL = 2 # seconds
+
+    def __init__(self, root='.', interval=INTERVAL, caches=()):
+        self.__root = root
+        self.__interval = interval
+        self.__caches = caches # the caches of the served files (BlockCache, CompressedFiles)
+        self.__files = {} # name: (size, mtime_ns, inode)
+        self.__lock = threading.Lock()
+        self.__scans = 0
+
+        self.scan()
+        threading.Thread(target=self.poll, daemon=True).start()
+
+
+    @property
+    def Files(self):
+        return len(self.__files)
+
+    @property
+    def Scans(self):
+        return self.__scans
+
+
+    def lookup(self, name):
+        """ Return (size, mtime_ns, inode) of the regular file, None if there's no such file """
+
+        entry = self.__files.get(name) # a dict read is atomic, no lock on the request path
+        if entry is None:
+            entry = self.refresh(name)
+        return entry
+
+
+    def refresh(self, name):
+        """ Stat the file again (created, written or removed by the server), return its entry """
+
+        try:
+            st = os.stat(os.path.join(self.__root, name))
+        except OSError:
+            st = None
+
+        entry = None
+        if st is not None and stat.S_ISREG(st.st_mode):
+            entry = (st.st_size, st.st_mtime_ns, st.st_ino)
+
+        with self.__lock:
+            old = self.__files.pop(name, None)
+            if entry is not None:
+                self.__files[name] = entry
+        if old is not None and old != entry:
+            self.invalidate(name)
+        return entry
+
+
+    def scan(self):
+        # one pass over the directory (the file type comes from the directory entry,
+        # only the regular files are stat'ed)
+        files = {}
+        with os.scandir(self.__root) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file():
+                        st = entry.stat()
+                        files[entry.name] = (st.st_size, st.st_mtime_ns, st.st_ino)
+                except OSError:
+                    pass # removed meanwhile
+
+        with self.__lock:
+            changed = [name for name, meta in self.__files.items() if files.get(name) != meta]
+            self.__files = files
+            self.__scans += 1
+
+        for name in changed:
+            self.invalidate(name)
+
+
+    def invalidate(self, name):
+        # the blocks of the old version of the file are dropped from the caches
+        for cache in self.__caches:
+            cache.invalidate(name)
+
+
+    def poll(self):
+        while True:
+            time.sleep(self.__interval)
+            try:
+                self.scan()
+            except OSError as e:
+                log.error("Index scan error (%s): %s", self.__root, e)
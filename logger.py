@@ -0,0 +1,102 @@
+import atexit
+import itertools
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+# Logger shared by the server, the client and the TFTP methods
+log = logging.getLogger('tftp')
+
+# JSON packet trace, written to its own file
+trace_log = logging.getLogger('tftp.trace')
+trace_log.propagate = False
+
+_listeners = []
+
+
+class PacketTrace:
+    """ Per-packet events (off by default).
+        The transfer loops check `enabled` before building anything, so a disabled trace
+        costs one attribute lookup per packet. Enabled events are logged for 1 of every
+        `sample` packets and are all written to the trace file when there is one """
+
+    def __init__(self):
+        self.enabled = False
+        self.sample = 0 # 0 - no per-packet log records
+        self.to_file = False
+        self.__counter = itertools.count()
+
+    def record(self, event, addr, block_no, length=None):
+        if self.sample and next(self.__counter) % self.sample == 0:
+            if length is None:
+                log.debug("[%s]: (%s) block(%d)", event, addr, block_no)
+            else:
+                log.debug("[%s]: (%s) block(%d) length(%d)", event, addr, block_no, length)
+
+        if self.to_file:
+            trace_log.info(json.dumps({'time': time.time(), 'event': event, 'addr': list(addr),
+                                        'block': block_no, 'length': length}))
+
+
+packets = PacketTrace()
+
+
+def setup_logging(level='info', packet_sample=0, trace_file=None):
+    """ Configure the tftp logger, the records are formatted and written by a background
+        thread (QueueListener) so the transfers never wait for terminal or journal I/O
+        packet_sample: log 1 of every N packets (0 - none, 1 - all)
+        trace_file: write every packet as a JSON line to this file """
+
+    stop_logging() # reconfigure (like in a forked worker process)
+
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    _listen(log, handler)
+    log.setLevel(logging.DEBUG if packet_sample else getattr(logging, level.upper()))
+
+    packets.sample = packet_sample
+    packets.to_file = trace_file is not None
+    packets.enabled = bool(packet_sample) or packets.to_file
+
+    if trace_file is not None:
+        handler = logging.FileHandler(trace_file)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        _listen(trace_log, handler)
+        trace_log.setLevel(logging.INFO)
+
+
+def _listen(logger, handler):
+    records = queue.SimpleQueue()
+    for old in list(logger.handlers):
+        logger.removeHandler(old)
+    logger.addHandler(logging.handlers.QueueHandler(records))
+
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+    _listeners.append(listener)
+
+
+def stop_logging():
+    # write the queued records and stop the background threads
+    while _listeners:
+        listener = _listeners.pop()
+        try:
+            listener.stop()
+        except AttributeError:
+            pass # the thread was not started in this (forked) process
+
+
+atexit.register(stop_logging)
+
+
+def transfer_summary(transfer, request, addr):
+    """ Log the summary of a finished transfer (the default level of details) """
+
+    elapsed = max(time.monotonic() - transfer.started, 1e-6)
+    status = 'completed' if transfer.completed else 'failed'
+    log.info("[TRANSFER %s]: %s %s (%s) %d bytes in %.3fs (%.2f MB/s), %d retransmissions",
+                status.upper(), request, transfer.stream.Filename, addr, transfer.bytes,
+                elapsed, transfer.bytes / elapsed / 1e6, transfer.retransmissions)
@@ -0,0 +1,257 @@
+import bisect
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logger import log
+
+
+class Histogram:
+    """ Distribution of observed values in fixed buckets (upper bounds),
+        exported as a Prometheus histogram (cumulative buckets, sum and count) """
+
+    def __init__(self, bounds):
+        self.__bounds = tuple(bounds)
+        self.__counts = [0] * (len(self.__bounds) + 1) # the last one is +Inf
+        self.__sum = 0.0
+        self.__count = 0
+
+    @property
+    def Bounds(self):
+        return self.__bounds
+
+    @property
+    def Sum(self):
+        return self.__sum
+
+    @property
+    def Count(self):
+        return self.__count
+
+    def observe(self, value):
+        self.__counts[bisect.bisect_left(self.__bounds, value)] += 1
+        self.__sum += value
+        self.__count += 1
+
+    def cumulative(self):
+        # [(upper bound, observations <= bound), ...] ending with +Inf
+        result = []
+        total = 0
+        for bound, count in zip(self.__bounds + (float('inf'),), self.__counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+
+class Metrics:
+    """ Counters and histograms of the server's transfers.
+        Most of them are updated once per request and once per finished transfer, so
+        collecting them is always on. The bytes and retransmissions of the running transfers
+        are read from their Transfer objects when the metrics are exported, and the
+        per-stage timing of every block (read, pack, send, wait) is collected only when
+        stage_timing is set """
+
+    DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300) # seconds
+    RTT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+    STAGE_BUCKETS = (0.000001, 0.000005, 0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.1, 1)
+    STAGES = ('read', 'pack', 'send', 'wait')
+    MAX_CLIENTS = 1024 # clients kept for the per-client throughput (least recent are dropped)
+
+    def __init__(self):
+        self.stage_timing = False
+        self.__lock = threading.Lock()
+        self.__started = time.time()
+        self.__requests = {'RRQ': 0, 'WRQ': 0}
+        self.__transfers = {'completed': 0, 'failed': 0}
+        self.__errors = {} # error code: ERROR packets sent
+        self.__bytes = {'RRQ': 0, 'WRQ': 0} # data bytes of the finished transfers
+        self.__retransmissions = 0 # of the finished transfers
+        self.__active = {} # Transfer: (request, client address)
+        self.__clients = OrderedDict() # client IP: [bytes, seconds, transfers], in LRU order
+        self.__duration = Histogram(Metrics.DURATION_BUCKETS)
+        self.__rtt = Histogram(Metrics.RTT_BUCKETS)
+        self.__stages = {stage: Histogram(Metrics.STAGE_BUCKETS) for stage in Metrics.STAGES}
+
+
+    def request(self, request):
+        with self.__lock:
+            self.__requests[request] += 1
+
+
+    def error_sent(self, code):
+        with self.__lock:
+            self.__errors[code] = self.__errors.get(code, 0) + 1
+
+
+    def stage(self, stage, seconds):
+        with self.__lock:
+            self.__stages[stage].observe(seconds)
+
+
+    def transfer_started(self, transfer, request, addr):
+        with self.__lock:
+            self.__active[transfer] = (request, addr)
+
+
+    def transfer_finished(self, transfer):
+        elapsed = time.monotonic() - transfer.started
+
+        with self.__lock:
+            entry = self.__active.pop(transfer, None)
+            if entry is None:
+                return # not started or already finished
+            request, addr = entry
+
+            self.__transfers['completed' if transfer.completed else 'failed'] += 1
+            self.__bytes[request] += transfer.bytes
+            self.__retransmissions += transfer.retransmissions
+            self.__duration.observe(elapsed)
+            if transfer.rtt.Srtt is not None:
+                self.__rtt.observe(transfer.rtt.Srtt)
+
+            client = self.__clients.pop(addr[0], None) or [0, 0.0, 0]
+            client[0] += transfer.bytes
+            client[1] += elapsed
+            client[2] += 1
+            self.__clients[addr[0]] = client
+            if len(self.__clients) > Metrics.MAX_CLIENTS:
+                self.__clients.popitem(last=False)
+
+
+    def snapshot(self):
+        """ The metrics as a dict (JSON), with the details of every running transfer """
+
+        now = time.monotonic()
+        with self.__lock:
+            active = []
+            bytes_total = dict(self.__bytes)
+            retransmissions = self.__retransmissions
+            for transfer, (request, addr) in self.__active.items():
+                bytes_total[request] += transfer.bytes
+                retransmissions += transfer.retransmissions
+                active.append({'request': request, 'client': list(addr), 'file': transfer.stream.Filename,
+                                'bytes': transfer.bytes, 'elapsed': now - transfer.started,
+                                'retransmissions': transfer.retransmissions, 'windowsize': transfer.windowsize,
+                                'blksize': transfer.stream.BlckSize, 'srtt': transfer.rtt.Srtt, 'rto': transfer.rtt.Rto})
+
+            histograms = {'transfer_duration_seconds': self.__duration, 'transfer_rtt_seconds': self.__rtt}
+            if self.stage_timing:
+                for stage, histogram in self.__stages.items():
+                    histograms['stage_%s_seconds' % stage] = histogram
+
+            return {
+                'time': time.time(),
+                'pid': os.getpid(),
+                'uptime': time.time() - self.__started,
+                'requests': dict(self.__requests),
+                'transfers': dict(self.__transfers, active=len(active)),
+                'bytes': {'sent': bytes_total['RRQ'], 'received': bytes_total['WRQ']},
+                'retransmissions': retransmissions,
+                'errors': {str(code): count for code, count in self.__errors.items()},
+                'clients': {ip: {'bytes': b, 'seconds': s, 'transfers': n, 'throughput': b / s if s else 0.0}
+                                for ip, (b, s, n) in self.__clients.items()},
+                'histograms': {name: {'buckets': [['+Inf' if bound == float('inf') else bound, count]
+                                                    for bound, count in h.cumulative()],
+                                        'sum': h.Sum, 'count': h.Count}
+                                for name, h in histograms.items()},
+                'active': active,
+            }
+
+
+    def render(self):
+        """ The metrics in the Prometheus text exposition format """
+
+        snap = self.snapshot()
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append('# HELP tftp_%s %s' % (name, help))
+            lines.append('# TYPE tftp_%s %s' % (name, kind))
+            for labels, value in samples:
+                lines.append('tftp_%s%s %s' % (name, labels, repr(float(value))))
+
+        metric('uptime_seconds', 'gauge', 'Seconds since the server started', [('', snap['uptime'])])
+        metric('requests_total', 'counter', 'Accepted requests by type',
+                [('{type="%s"}' % name, count) for name, count in snap['requests'].items()])
+        metric('transfers_total', 'counter', 'Finished transfers by result',
+                [('{result="%s"}' % result, snap['transfers'][result]) for result in ('completed', 'failed')])
+        metric('transfers_active', 'gauge', 'Running transfers', [('', snap['transfers']['active'])])
+        metric('bytes_total', 'counter', 'Data bytes sent (RRQ) and received (WRQ)',
+                [('{direction="%s"}' % direction, count) for direction, count in snap['bytes'].items()])
+        metric('retransmissions_total', 'counter', 'Retransmitted packets', [('', snap['retransmissions'])])
+        metric('errors_sent_total', 'counter', 'ERROR packets sent by error code',
+                [('{code="%s"}' % code, count) for code, count in snap['errors'].items()])
+        metric('client_bytes_total', 'counter', 'Data bytes of the finished transfers per client',
+                [('{client="%s"}' % ip, client['bytes']) for ip, client in snap['clients'].items()])
+        metric('client_throughput_bytes_per_second', 'gauge', 'Average throughput of the transfers per client',
+                [('{client="%s"}' % ip, client['throughput']) for ip, client in snap['clients'].items()])
+
+        for name, histogram in snap['histograms'].items():
+            lines.append('# TYPE tftp_%s histogram' % name)
+            for bound, count in histogram['buckets']:
+                lines.append('tftp_%s_bucket{le="%s"} %d' % (name, bound, count))
+            lines.append('tftp_%s_sum %r' % (name, histogram['sum']))
+            lines.append('tftp_%s_count %d' % (name, histogram['count']))
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """ GET /metrics (Prometheus text format) and /metrics.json """
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            body = metrics.render().encode()
+            content_type = 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body = json.dumps(metrics.snapshot()).encode()
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug("[METRICS]: (%s) " + format, self.client_address, *args)
+
+
+
+def write_snapshots(filename, interval):
+    # rewrite the JSON snapshot every interval seconds, the file is replaced
+    # atomically so a reader never sees a partial snapshot
+    while True:
+        time.sleep(interval)
+        try:
+            temp = filename + '.tmp'
+            with open(temp, 'w') as f:
+                json.dump(metrics.snapshot(), f)
+            os.replace(temp, filename)
+        except OSError as e:
+            log.error("Metrics snapshot error: %s", e)
+
+
+def start_metrics(port=None, snapshot_file=None, interval=10, stage_timing=False):
+    """ Export the metrics of this process by HTTP on a local port (/metrics, /metrics.json)
+        and/or as a JSON snapshot file rewritten every interval seconds, in background threads """
+
+    metrics.stage_timing = stage_timing
+
+    if port:
+        httpd = ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        log.info("Metrics are served on (http://127.0.0.1:%d/metrics)", port)
+
+    if snapshot_file:
+        threading.Thread(target=write_snapshots, args=(snapshot_file, interval), daemon=True).start()
@@ -0,0 +1,677 @@
+import os
+import select
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
+from tftp import TFTP, Transfer, RttEstimator
+from logger import log, packets, transfer_summary
+from metrics import metrics
+
+# Multicast TFTP (RFC 2090): the server streams a file once to a multicast group, every
+# client that asks the same file joins the group and gets the blocks it's sent. One of the
+# clients at a time is the master client, only it acknowledges the blocks (unicast) and so
+# drives the stream. Once the master got the whole file the next client becomes the master,
+# it asks from the first block it's missing - a client that joined in the middle of the
+# stream gets only the blocks sent before it joined.
+#
+#   the option of the RRQ:  multicast  ""
+#   the value in the OACK:  multicast  "group address,port,mc"   mc 1 - the master client
+#
+# The block numbers of a group can't roll over (a client joining in the middle of the stream
+# doesn't know how many times they did), so only the files of less than 65535 blocks are sent
+# by multicast, the option is not acknowledged for larger files.
+
+
+def pack_multicast(group, master):
+    return f"{group[0]},{group[1]},{1 if master else 0}"
+
+
+def parse_multicast(value):
+    """ Return ((group address, port), master) of the OACK value, None if it's not valid """
+
+    fields = value.split(',')
+    if len(fields) != 3 or not TFTP.is_number(fields[1]) or fields[2] not in ('0', '1'):
+        return None
+    try:
+        socket.inet_aton(fields[0])
+    except OSError:
+        return None
+    return (fields[0], int(fields[1])), fields[2] == '1'
+
+
+
+class MulticastGroups:
+    """ The multicast sessions of a server, a session per file, block size and window size.
+        The group of a session gets its address from the prefix (a /16) and the session port,
+        so the sessions of all the worker processes of the host have distinct groups, the
+        clients receive on the port of the groups (1758, tftp-mcast) """
+
+    PORT = 1758
+
+    def __init__(self, prefix='239.255.0.0', port=PORT, ttl=1, interface=None):
+        self.__prefix = socket.inet_aton(prefix)[:2]
+        self.__port = port
+        self.__ttl = ttl # hops of the DATA packets, 1 - the local network
+        self.__interface = interface # address of the interface sending to the groups, None - the default route
+        self.__sessions = {} # (filename, blksize, windowsize): MulticastSession
+        self.lock = threading.Lock() # joins and the sessions' client lists
+
+
+    def create_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('', 0))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.__ttl)
+        # clients on the server host receive the DATA packets too
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        if self.__interface:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.__interface))
+        group = (socket.inet_ntoa(self.__prefix + struct.pack('!H', sock.getsockname()[1])), self.__port)
+        return sock, group
+
+
+    def join(self, server, key, addr_client, options, open_reader, timeout, retries, mode):
+        """ Add the client to the session of the file (a new session is started for the
+            first client), open_reader() opens the reader of a new session """
+
+        with self.lock:
+            session = self.__sessions.get(key)
+            if session is None:
+                sock, group = self.create_socket()
+                windowsize = options.get(TFTP.OPT_WINDOWSIZE, 1)
+                transfer = Transfer(open_reader(), windowsize, timeout, retries)
+                session = MulticastSession(self, server, key, sock, group, transfer, mode)
+                self.__sessions[key] = session
+                threading.Thread(target=session.run, daemon=True).start()
+            session.join(addr_client, options)
+
+
+    def remove(self, key, session):
+        # called with the lock held, a join after that starts a new session
+        if self.__sessions.get(key) is session:
+            del self.__sessions[key]
+
+
+
+class MulticastSession(TFTP):
+    """ A file streamed to a multicast group by its own thread (also by the asyncio engine,
+        a session serves any number of clients). The DATA windows are sent to the group on
+        the ACKs of the master client, the clients are made masters in the order they joined """
+
+    def __init__(self, groups, server, key, sock, group, transfer, mode):
+        super().__init__(transfer.stream.BlckSize, mode)
+        self.__groups = groups
+        self.__server = server
+        self.__key = key
+        self.__sock = sock
+        self.__group = group
+        self.__transfer = transfer
+        self.__mode = mode
+        self.__clients = OrderedDict() # client address: its accepted options, in join order
+        self.__master = None
+        self.__fresh = False # the master didn't ACK yet, its first ACK tells what it's missing
+
+
+    @property
+    def Group(self):
+        return self.__group
+
+
+    def send_oack(self, addr, master):
+        options = dict(self.__clients[addr], **{TFTP.OPT_MULTICAST: pack_multicast(self.__group, master)})
+        packet = TFTP.pack_oack(options)
+        TFTP.send_packet(packet, self.__sock, addr)
+        return packet
+
+
+    def join(self, addr, options):
+        # called with the lock held, a client that asks again (its OACK was lost) gets it again
+        self.__clients[addr] = {name: value for name, value in options.items() if name != TFTP.OPT_MULTICAST}
+        if self.__master is None or self.__master == addr:
+            self.promote(addr)
+            return
+
+        self.send_oack(addr, False)
+        self.__server.log(f"[MULTICAST]: ({addr}) joined the group {self.__group} of ({self.__key[0]})")
+
+
+    def promote(self, addr):
+        # the master is told by an OACK with mc 1, it answers by the ACK of the blocks it has
+        self.__master = addr
+        self.__fresh = True
+        transfer = self.__transfer
+        transfer.last_packet = self.send_oack(addr, True)
+        transfer.retries = 0
+        transfer.arm()
+        self.__server.log(f"[MULTICAST]: ({addr}) is the master client of {self.__group} ({self.__key[0]})")
+
+
+    def next_master(self):
+        # the master is done (or gone), the next client continues the stream
+        self.__clients.pop(self.__master, None)
+        self.__master = None
+        if self.__clients:
+            self.promote(next(iter(self.__clients)))
+
+
+    def handle_packet(self, packet, addr):
+        if addr not in self.__clients:
+            self.__server.send_error(5, self.__sock, addr) # 'Unknown Transfer TID' ERROR
+            return
+
+        opcode = TFTP.get_opcode(packet)
+
+        if opcode == TFTP.ERR_OPCODE:
+            # the client left the group
+            opcode, error_code, error_msg = TFTP.unpack_error(packet)
+            self.__server.log(f"[Client Reply]: ({addr}) Error Message: {error_msg}, ERROR_CODE: ({error_code})")
+            if addr == self.__master:
+                self.next_master()
+            else:
+                del self.__clients[addr]
+
+        elif opcode == TFTP.ACK_OPCODE:
+            # only the master acknowledges, the other clients just listen
+            if addr == self.__master:
+                self.get_ack(packet)
+
+        else:
+            self.__server.send_error(4, self.__sock, addr) # 'Illegal TFTP operation' ERROR
+            if addr == self.__master:
+                self.next_master()
+            else:
+                del self.__clients[addr]
+
+
+    def get_ack(self, packet):
+        """ The master acknowledges the blocks it has received in order, the next window
+            is sent from there (the block numbers of a group don't roll over) """
+
+        transfer = self.__transfer
+        opcode, block_no = TFTP.unpack_ack(packet)
+        if packets.enabled:
+            packets.record('GET ACK', self.__master, block_no)
+
+        if transfer.last_block is not None and block_no >= transfer.last_block:
+            # the master has the whole file
+            transfer.completed = True
+            self.next_master()
+            return
+
+        if self.__fresh:
+            # a new master asks from its first missing block, maybe back in the file
+            self.__fresh = False
+            transfer.acked = block_no
+        elif block_no <= transfer.acked or block_no > transfer.sent:
+            # an older ACK or a duplicate, lost blocks are resent by the timer
+            return
+        else:
+            transfer.acked = block_no
+
+        transfer.progress()
+        self.send_window(transfer, self.__sock, self.__group, self.__mode)
+
+
+    def timeout(self):
+        # resend the window (or the OACK of a new master), a master that doesn't answer
+        # is dropped and the next client becomes the master
+        transfer = self.__transfer
+        if transfer.retries >= transfer.max_retries:
+            log.warning("Multicast master client timeouts (%s)", self.__master)
+            self.next_master()
+            return
+
+        transfer.retries += 1
+        transfer.retransmissions += 1
+        transfer.rtt.backoff()
+        log.debug("[RETRANSMIT]: (%s) retry(%d) timeout(%.3f)", self.__group, transfer.retries, transfer.rtt.Rto)
+
+        if self.__fresh:
+            TFTP.send_packet(transfer.last_packet, self.__sock, self.__master)
+            transfer.arm()
+        else:
+            self.send_window(transfer, self.__sock, self.__group, self.__mode)
+
+
+    def run(self):
+        transfer = self.__transfer
+        metrics.transfer_started(transfer, 'RRQ', self.__group)
+        view = memoryview(bytearray(1024)) # the ACK/ERROR packets are received into it
+        try:
+            while True:
+                self.__sock.settimeout(transfer.timeout())
+                try:
+                    packet, addr = TFTP.receive(self.__sock, view)
+                except socket.timeout:
+                    packet = None
+
+                with self.__groups.lock:
+                    if packet is None:
+                        if time.monotonic() >= transfer.deadline:
+                            self.timeout()
+                    else:
+                        self.handle_packet(packet, addr)
+
+                    if self.__master is None:
+                        # every client got the file (or left)
+                        self.__groups.remove(self.__key, self)
+                        return
+
+        except Exception as e:
+            log.error("Multicast session error (%s): %s", self.__group, e)
+            with self.__groups.lock:
+                self.__groups.remove(self.__key, self)
+
+        finally:
+            self.__sock.close()
+            transfer.close()
+            self.__server.finish_transfer(transfer, self.__group)
+
+
+
+class MulticastWriter:
+    """ Block writer of a file received from a multicast group. The blocks arrive in any
+        order (the client joined in the middle of the stream, the master asks the missing
+        ones later), they are written at their offsets and a block map tracks the missing ones """
+
+    def __init__(self, filename, blksize, size=None):
+        self.__filename = filename
+        self.__blksize = blksize
+        self.__fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        self.__blocks = bytearray() # 1 - the block (1-based, at index block - 1) was written
+        self.__prefix = 0 # the blocks 1..prefix were all written
+        self.__last_block = None
+        self.__size = None # of the file, once the last block was written
+        self.__length = 0 # bytes written
+
+        if size and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self.__fd, 0, size)
+            except OSError:
+                pass # not supported by the filesystem
+
+
+    @property
+    def Filename(self):
+        return self.__filename
+
+    @property
+    def BlckSize(self):
+        return self.__blksize
+
+    @property
+    def Length(self):
+        return self.__length
+
+    @property
+    def Prefix(self):
+        return self.__prefix
+
+    @property
+    def LastBlock(self):
+        return self.__last_block
+
+    @property
+    def Complete(self):
+        return self.__last_block is not None and self.__prefix >= self.__last_block
+
+
+    def write_block(self, block_no, data):
+        """ Write the data of the given block (1-based) at its offset,
+            return False if the block was already written """
+
+        if block_no <= len(self.__blocks) and self.__blocks[block_no - 1]:
+            return False
+
+        if block_no > len(self.__blocks):
+            self.__blocks.extend(bytes(block_no - len(self.__blocks)))
+        os.pwrite(self.__fd, data, (block_no - 1) * self.__blksize)
+        self.__blocks[block_no - 1] = 1
+        self.__length += len(data)
+
+        if len(data) < self.__blksize:
+            self.__last_block = block_no
+            self.__size = (block_no - 1) * self.__blksize + len(data)
+
+        while self.__prefix < len(self.__blocks) and self.__blocks[self.__prefix]:
+            self.__prefix += 1
+        return True
+
+
+    def close(self):
+        if self.__fd is None:
+            return
+        try:
+            if self.__size is not None:
+                # drop the preallocated space after the end of the file
+                os.ftruncate(self.__fd, self.__size)
+        finally:
+            os.close(self.__fd)
+            self.__fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+
+class MulticastClient(TFTP):
+    """ Get a file by multicast (RFC 2090): the DATA packets are received from the group
+        told by the server's OACK, they are acknowledged only while this client is the
+        master. A client that isn't the master asks the file again when the server is
+        silent, the server answers by the OACK - it's still in the group """
+
+    def __init__(self, ip, port, filename, targetname, timeout, blksize, buffer_size, is_logging,
+                    windowsize=1, retries=5, interface=None):
+        super().__init__(blksize, TFTP.TRANSFER_MODES[1])
+        self.__ip = ip
+        self.__port = port # TFTP Protocol Port (69)
+        self.__filename = filename
+        self.__targetname = targetname
+        self.__timeout = timeout
+        self.__buffer_size = buffer_size
+        self.__is_logging = is_logging
+        self.__windowsize = windowsize
+        self.__retries = retries
+        # address of the interface receiving the group, None - the one routing to the server
+        self.__interface = interface
+        self.__transfer = None # created by the first OACK
+        self.__error = None
+        self.__server_addr = None # the port (TID) of the server's session
+        self.__group = None
+        self.__group_sock = None
+        self.__master = False
+
+
+    @property
+    def ActiveTransfer(self):
+        return self.__transfer
+
+    @property
+    def Error(self):
+        return self.__error
+
+
+    def request_options(self):
+        options = {TFTP.OPT_MULTICAST: ''}
+        if self.BlckSize != TFTP.DEFAULT_BLKSIZE:
+            options[TFTP.OPT_BLKSIZE] = self.BlckSize
+        if self.__windowsize > 1:
+            options[TFTP.OPT_WINDOWSIZE] = self.__windowsize
+        if isinstance(self.__timeout, int) and TFTP.MIN_TIMEOUT <= self.__timeout <= TFTP.MAX_TIMEOUT:
+            options[TFTP.OPT_TIMEOUT] = self.__timeout
+        options[TFTP.OPT_TSIZE] = 0
+        return options
+
+
+    def accept_oack(self, requested, options):
+        """ Return True if the server acknowledged the multicast option and only requested options
+            with valid values (the block and window sizes may only be lowered by the server) """
+
+        if not TFTP.check_options(options) or any(name not in requested for name in options):
+            return False
+        if parse_multicast(options.get(TFTP.OPT_MULTICAST, '')) is None:
+            return False
+        if int(options.get(TFTP.OPT_BLKSIZE, TFTP.DEFAULT_BLKSIZE)) > self.BlckSize:
+            return False
+        return int(options.get(TFTP.OPT_WINDOWSIZE, 1)) <= self.__windowsize
+
+
+    def join_group(self, group, sock):
+        # the membership is on the interface that routes to the server (by default)
+        interface = self.__interface or sock.getsockname()[0]
+        if interface == '0.0.0.0':
+            probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            probe.connect((self.__ip, self.__port)) # no packet is sent
+            interface = probe.getsockname()[0]
+            probe.close()
+
+        if self.__group_sock is None:
+            # every client of the host receives the groups on their port
+            self.__group_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.__group_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.__group_sock.bind(('', group[1]))
+            TFTP.fit_receive_buffer(self.__group_sock, self.__transfer)
+        elif self.__group is not None:
+            # a new session of the file (the old one ended), leave its group
+            mreq = socket.inet_aton(self.__group[0]) + socket.inet_aton(self.__interface_addr)
+            self.__group_sock.setsockopt(socket.IPPROTO_IP, socket.IP_DROP_MEMBERSHIP, mreq)
+
+        mreq = socket.inet_aton(group[0]) + socket.inet_aton(interface)
+        self.__group_sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        self.__group = group
+        self.__interface_addr = interface
+
+
+    def send_request(self, sock):
+        TFTP.send_packet(self.__request, sock, (self.__ip, self.__port))
+        # a client that isn't the master waits the negotiated timeout for the server
+        self.__deadline = time.monotonic() + self.__rtt.Rto
+
+
+    def send_ack(self, sock):
+        # acknowledge the blocks received in order, the server continues from there
+        transfer = self.__transfer
+        transfer.acked = transfer.received = transfer.stream.Prefix
+        transfer.last_packet = TFTP.pack_ack(transfer.acked)
+        TFTP.send_packet(transfer.last_packet, sock, self.__server_addr)
+        transfer.arm()
+        self.__deadline = transfer.deadline
+        if packets.enabled:
+            packets.record('SEND ACK', self.__server_addr, transfer.acked)
+
+
+    def handle_timeout(self, sock):
+        """ Resend the ACK (master) or the request, return False once the retry budget is spent """
+
+        retries = self.__transfer.retries if self.__transfer is not None else self.__request_retries
+        if retries >= self.__retries:
+            log.warning("Connection timeouts")
+            self.__error = "Connection timeouts"
+            return False
+
+        if self.__transfer is None:
+            self.__request_retries += 1
+            self.__rtt.backoff()
+            self.send_request(sock)
+            return True
+
+        self.__transfer.retries += 1
+        self.__transfer.retransmissions += 1
+        if self.__master:
+            self.__rtt.backoff()
+            self.send_ack(sock)
+        else:
+            self.send_request(sock)
+            self.__deadline = time.monotonic() + self.__transfer_timeout
+        return True
+
+
+    def handle_oack(self, packet, addr, sock):
+        opcode, accepted = TFTP.unpack_oack(packet)
+        if not self.accept_oack(self.__options, accepted):
+            TFTP.send_packet(TFTP.pack_error(8), sock, addr) # 'Option Negotiation Failed' ERROR
+            self.__error = TFTP.TFTP_ERRORS[8]
+            return False
+
+        group, master = parse_multicast(accepted[TFTP.OPT_MULTICAST])
+        if self.__transfer is None:
+            log.info("[GET OACK]: (%s) options(%s)", addr, accepted)
+            self.BlckSize = int(accepted.get(TFTP.OPT_BLKSIZE, TFTP.DEFAULT_BLKSIZE))
+            tsize = int(accepted[TFTP.OPT_TSIZE]) if TFTP.OPT_TSIZE in accepted else None
+            self.__transfer_timeout = int(accepted.get(TFTP.OPT_TIMEOUT, self.__timeout))
+            self.__transfer = Transfer(MulticastWriter(self.__targetname, self.BlckSize, tsize),
+                                        int(accepted.get(TFTP.OPT_WINDOWSIZE, 1)), self.__transfer_timeout,
+                                        self.__retries, self.__rtt)
+        elif self.BlckSize != int(accepted.get(TFTP.OPT_BLKSIZE, TFTP.DEFAULT_BLKSIZE)):
+            TFTP.send_packet(TFTP.pack_error(8), sock, addr) # 'Option Negotiation Failed' ERROR
+            self.__error = TFTP.TFTP_ERRORS[8]
+            return False
+
+        self.__server_addr = addr
+        if group != self.__group:
+            self.join_group(group, sock)
+
+        self.__transfer.retries = 0
+        if master and not self.__master:
+            log.info("[MULTICAST]: master client of %s", group)
+        self.__master = master
+        if master:
+            self.send_ack(sock)
+        else:
+            self.__deadline = time.monotonic() + self.__transfer_timeout
+        return True
+
+
+    def get_dat(self, packet, sock):
+        """ Write a block of the group, the master acknowledges the end of the window it
+            asked (or the blocks in order up to a lost one), return False once the final
+            ACK was sent """
+
+        transfer = self.__transfer
+        opcode, block_no, data = TFTP.unpack_dat(packet)
+        if packets.enabled:
+            packets.record('GET DATA', self.__group, block_no, len(data))
+        if block_no == 0:
+            return True
+
+        if transfer.stream.write_block(block_no, data):
+            transfer.bytes += len(data)
+
+        if not self.__master:
+            # the session is alive
+            transfer.retries = 0
+            self.__deadline = time.monotonic() + self.__transfer_timeout
+            return True
+
+        transfer.progress()
+        self.__deadline = transfer.deadline
+        if transfer.stream.Complete or block_no >= transfer.acked + transfer.windowsize or \
+                block_no == transfer.stream.LastBlock:
+            self.send_ack(sock)
+
+        if transfer.stream.Complete:
+            transfer.completed = True
+            transfer.final_acked = True # dally in case the final ACK is lost
+            return False
+        return True
+
+
+    def handle_packet(self, packet, addr, sock):
+        """ Handle a packet of the server (unicast) or of the group,
+            return True to wait for more packets, otherwise False to finalize the transfer """
+
+        opcode = TFTP.get_opcode(packet)
+
+        if opcode == TFTP.DAT_OPCODE:
+            if self.__transfer is None and addr[0] == self.__ip:
+                # the server ignored the options, it sends the file by unicast
+                TFTP.send_packet(TFTP.pack_error(8), sock, addr) # 'Option Negotiation Failed' ERROR
+                self.__error = TFTP.TFTP_ERRORS[8]
+                return False
+            # the DATA packets of other senders to the group are ignored
+            if addr != self.__server_addr:
+                return True
+            return self.get_dat(packet, sock)
+
+        if addr[0] != self.__ip:
+            return True
+
+        if opcode == TFTP.OACK_OPCODE:
+            if self.__server_addr is None and self.__request_retries == 0:
+                self.__rtt.sample(time.monotonic() - self.__request_sent)
+            return self.handle_oack(packet, addr, sock)
+
+        if opcode == TFTP.ERR_OPCODE:
+            opcode, error_code, error_msg = TFTP.unpack_error(packet)
+            log.error("[Server Reply]: Error Message: %s, ERROR_CODE: (%s)", error_msg, error_code)
+            self.__error = f"{error_msg} ({error_code})"
+            return False
+
+        TFTP.send_packet(TFTP.pack_error(4), sock, addr) # 'Illegal TFTP operation' ERROR
+        self.__error = TFTP.TFTP_ERRORS[4]
+        return False
+
+
+    def receive(self, sock, timeout):
+        # the next packet of the unicast socket or of the group, None on timeout
+        socks = [sock] if self.__group_sock is None else [sock, self.__group_sock]
+        readable, _, _ = select.select(socks, [], [], max(timeout, 0))
+        if not readable:
+            return None
+        return TFTP.receive(readable[0], self.__view)
+
+
+    def handle_request(self):
+        """ Run the get, return True if the whole file was received """
+
+        sock = None
+        try:
+            # the server's packets are told from the group's by the address
+            self.__ip = socket.gethostbyname(self.__ip)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.__options = self.request_options()
+            self.__request = self.pack_rq_header(TFTP.RRQ_OPCODE, self.__filename, self.TransferMode, self.__options)
+            self.__rtt = RttEstimator(self.__timeout, self.__timeout)
+            self.__view = memoryview(bytearray(max(self.__buffer_size, self.BlckSize + 4)))
+            self.__request_sent = time.monotonic()
+            self.__request_retries = 0
+            self.send_request(sock)
+
+            while True:
+                received = self.receive(sock, self.__deadline - time.monotonic())
+                if received is None:
+                    if self.handle_timeout(sock):
+                        continue
+                    break
+
+                if not self.handle_packet(*received, sock):
+                    if self.__transfer is not None and self.__transfer.final_acked:
+                        self.dally_group(sock)
+                    break
+
+        except Exception as e:
+            log.error("Error: %s", e)
+            self.__error = str(e)
+
+        finally:
+            if sock is not None:
+                sock.close()
+            if self.__group_sock is not None:
+                self.__group_sock.close()
+
+        try:
+            return self.finish()
+        except Exception as e:
+            # the close of the target failed (like a full disk)
+            log.error("Error: %s", e)
+            self.__error = str(e)
+            return False
+
+
+    def dally_group(self, sock):
+        # the final ACK may be lost, the server resends the window to the group - only
+        # its last block is acknowledged again, the other packets (like the stream of the
+        # next master and its OACK) are not for this client, the session forgot it
+        deadline = time.monotonic() + self.__transfer.rtt.Rto
+        while True:
+            received = self.receive(sock, deadline - time.monotonic())
+            if received is None:
+                return
+            packet, addr = received
+            if addr == self.__server_addr and \
+                    TFTP.unpack_header(packet) == (TFTP.DAT_OPCODE, self.__transfer.stream.LastBlock):
+                self.send_ack(sock)
+
+
+    def finish(self):
+        if self.__transfer is None:
+            return False
+
+        self.__transfer.close()
+        if self.__is_logging:
+            transfer_summary(self.__transfer, 'get', self.__server_addr)
+        return self.__transfer.completed
@@ -0,0 +1,220 @@
+import os
+import re
+import threading
+from array import array
+from collections import OrderedDict
+from blockio import BlockWriter
+
+# netascii (RFC 764): a line ends with CR LF and a bare CR is sent as CR NUL
+SPECIAL = re.compile(b'[\r\n]')
+
+# the byte of a CR LF / CR NUL pair carried over to the next block when the
+# block boundary splits the pair (none, LF, NUL)
+CARRIED = (b'', b'\n', b'\x00')
+
+
+def encode(data):
+    # CR first, the CRs added before the LFs must not get a NUL
+    return data.replace(b'\r', b'\r\x00').replace(b'\n', b'\r\n')
+
+
+def decode(data):
+    return data.replace(b'\r\n', b'\n').replace(b'\r\x00', b'\r')
+
+
+def cut(source, size):
+    """ Return (source bytes, carried) of the prefix of source whose encoding fills size bytes,
+        carried is the index in CARRIED of the second byte of a pair split by the boundary """
+
+    count = 0
+    for match in SPECIAL.finditer(source):
+        position = match.start() + count # of the pair in the encoded data
+        if position >= size:
+            break
+        if position + 1 == size:
+            # the block ends with the CR of the pair
+            return match.start() + 1, 1 if source[match.start()] == 0x0A else 2
+        count += 1
+    return size - count, 0
+
+
+
+class NetasciiIndex:
+    """ Checkpoints of a file translated to netascii: the source offset (and the carried
+        byte) where every block starts. The translation changes the block boundaries,
+        with the index a block is found without translating the file from its start """
+
+    def __init__(self, identity):
+        self.__identity = identity
+        self.__checkpoints = array('Q', [0]) # offset * 4 + carried, of the blocks 1..N
+        self.__lock = threading.Lock()
+
+    @property
+    def Identity(self):
+        return self.__identity
+
+    @property
+    def Blocks(self):
+        return len(self.__checkpoints)
+
+    def get(self, block_no):
+        checkpoint = self.__checkpoints[block_no - 1]
+        return checkpoint >> 2, checkpoint & 3
+
+    def add(self, block_no, offset, carried):
+        # readers of the same file extend the index once, in order
+        with self.__lock:
+            if len(self.__checkpoints) == block_no - 1:
+                self.__checkpoints.append(offset << 2 | carried)
+
+
+
+class NetasciiIndexes:
+    """ Server-wide indexes shared by the netascii readers of the same file and block size,
+        an index is rebuilt when the file's identity (mtime, size, inode) changed """
+
+    MAX_INDEXES = 256
+
+    def __init__(self, max_indexes=MAX_INDEXES):
+        self.__max_indexes = max_indexes
+        self.__indexes = OrderedDict() # (filename, blksize): NetasciiIndex, in LRU order
+        self.__lock = threading.Lock()
+
+    def get(self, filename, blksize, identity):
+        key = (filename, blksize)
+        with self.__lock:
+            index = self.__indexes.pop(key, None)
+            if index is None or index.Identity != identity:
+                index = NetasciiIndex(identity)
+            self.__indexes[key] = index
+            if len(self.__indexes) > self.__max_indexes:
+                self.__indexes.popitem(last=False)
+            return index
+
+
+
+class NetasciiReader:
+    """ Per-transfer block reader of a file sent in netascii mode.
+        The blocks are translated from the buffered file while they are read, only a block
+        at a time is held. The block of a retransmission (or a concurrent reader) is found
+        by the checkpoint index, so every block costs O(1) """
+
+    READ_AHEAD = 64 * 1024
+
+    def __init__(self, filename, blksize, read_ahead=READ_AHEAD, indexes=None):
+        self.__filename = filename
+        self.__blksize = blksize
+        self.__file = open(filename, 'rb', buffering=max(read_ahead, blksize))
+        self.__position = 0 # of the buffered file
+
+        st = os.fstat(self.__file.fileno())
+        identity = (st.st_mtime_ns, st.st_size, st.st_ino)
+        self.__index = indexes.get(filename, blksize, identity) if indexes is not None else NetasciiIndex(identity)
+
+
+    @property
+    def Filename(self):
+        return self.__filename
+
+    @property
+    def BlckSize(self):
+        return self.__blksize
+
+
+    def read_block(self, block_no):
+        """ Return the netascii data of the given block (1-based), the last block
+            is shorter than the block size (maybe empty) """
+
+        # a block after the indexed ones (only when the blocks are read out of order)
+        while self.__index.Blocks < block_no:
+            last = self.__index.Blocks
+            self.translate(last, *self.__index.get(last))
+
+        return self.translate(block_no, *self.__index.get(block_no))
+
+
+    def translate(self, block_no, offset, carried):
+        data = CARRIED[carried]
+        size = self.__blksize - len(data)
+
+        if self.__position != offset:
+            # seeking inside the read-ahead buffer does not touch the disk
+            self.__file.seek(offset, os.SEEK_SET)
+        source = self.__file.read(size)
+        self.__position = offset + len(source)
+
+        encoded = encode(source)
+        if len(encoded) <= size:
+            self.__index.add(block_no + 1, offset + len(source), 0)
+            return data + encoded
+
+        # the encoding is longer than the block, the rest of the source starts the next block
+        consumed, carried = cut(source, size)
+        self.__index.add(block_no + 1, offset + consumed, carried)
+        return data + encoded[:size]
+
+
+    def close(self):
+        self.__file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+
+class NetasciiWriter:
+    """ Per-transfer block writer of a file received in netascii mode, the blocks are
+        translated back to the local line ends and written by a BlockWriter. A CR at the
+        end of a block is held until the next block tells if it starts a pair """
+
+    def __init__(self, filename, blksize, write_behind=BlockWriter.WRITE_BEHIND, fsync=False, size=None):
+        self.__writer = BlockWriter(filename, blksize, write_behind, fsync, size)
+        self.__next_block = 1
+        self.__cr = b'' # the held CR
+
+
+    @property
+    def Filename(self):
+        return self.__writer.Filename
+
+    @property
+    def BlckSize(self):
+        return self.__writer.BlckSize
+
+    @property
+    def Length(self):
+        return self.__writer.Length
+
+
+    def write_block(self, block_no, data):
+        """ Append the data of the given block (1-based),
+            return False if the block is a duplicate that was already written """
+
+        if block_no != self.__next_block:
+            return False
+
+        data = self.__cr + bytes(data)
+        self.__cr = b''
+        if data.endswith(b'\r'):
+            data, self.__cr = data[:-1], b'\r'
+
+        self.__writer.write_block(block_no, decode(data))
+        self.__next_block = block_no + 1
+        return True
+
+
+    def close(self):
+        if self.__cr:
+            # a bare CR at the end of the file
+            self.__writer.write_block(self.__next_block, self.__cr)
+            self.__cr = b''
+        self.__writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,102 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Prefetcher:
+    """ Background read-ahead of the RRQ transfers: a small pool of I/O threads reads the
+        next part of a file while the blocks before it are sent and acknowledged, so a
+        cold disk read overlaps with the network round trips instead of following the ACK.
+        Every transfer holds at most `depth` bytes read ahead (two segments of depth / 2) """
+
+    DEPTH = 256 * 1024
+    THREADS = 4
+
+    def __init__(self, depth=DEPTH, threads=THREADS):
+        self.__depth = depth
+        self.__pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='prefetch')
+
+    def open(self, fd, blksize, start=0, end=None):
+        """ The read-ahead of a file descriptor, the blocks are read from start up to end
+            (None - up to the end of the file) """
+        return ReadAhead(self.__pool, fd, blksize, self.__depth, start, end)
+
+
+
+class ReadAhead:
+    """ Per-transfer read-ahead. The file is read in segments (a multiple of the block size),
+        when a block of a segment is read the next segment is read in the background and the
+        kernel is told to read the one after it (posix_fadvise WILLNEED). A block out of the
+        segments (a retransmission of an older one) is read at once """
+
+    def __init__(self, pool, fd, blksize, depth, start=0, end=None):
+        self.__pool = pool
+        self.__fd = fd
+        self.__start = start
+        self.__end = end
+        self.__segment = max(depth // 2 // blksize, 1) * blksize
+        self.__segments = {} # segment number: future of its bytes (at most the current and the next)
+
+        advise(fd, start, 0, 'POSIX_FADV_SEQUENTIAL')
+
+
+    def read(self, offset, size):
+        """ Return size bytes from offset of the file (shorter at the end of the file) """
+
+        number, position = divmod(offset - self.__start, self.__segment)
+        if position + size > self.__segment:
+            # the segments are made of whole blocks, only another read size crosses them
+            return os.pread(self.__fd, size, offset)
+
+        future = self.__segments.get(number)
+        if future is None:
+            if self.__segments and number < min(self.__segments):
+                # behind the read-ahead (retransmission), it's kept going
+                return os.pread(self.__fd, size, offset)
+            future = self.schedule(number)
+
+        # the segments before this one are not read again, the next one is read ahead
+        for old in [n for n in self.__segments if n < number]:
+            del self.__segments[old]
+        if number + 1 not in self.__segments and not self.past_end(number + 1):
+            self.schedule(number + 1)
+            advise(self.__fd, self.offset(number + 2), self.__segment, 'POSIX_FADV_WILLNEED')
+
+        # a view of the segment, the block is not copied
+        return memoryview(future.result())[position:position + size]
+
+
+    def offset(self, number):
+        return self.__start + number * self.__segment
+
+
+    def past_end(self, number):
+        return self.__end is not None and self.offset(number) >= self.__end
+
+
+    def schedule(self, number):
+        size = self.__segment
+        if self.__end is not None:
+            size = min(size, self.__end - self.offset(number))
+        future = self.__segments[number] = self.__pool.submit(os.pread, self.__fd, size, self.offset(number))
+        return future
+
+
+    def close(self):
+        # the file descriptor is closed after this, no read may be running on it
+        for future in self.__segments.values():
+            if not future.cancel():
+                try:
+                    future.result()
+                except OSError:
+                    pass
+        self.__segments.clear()
+
+
+
+def advise(fd, offset, length, advice):
+    # a hint to the kernel's page cache, ignored where it's not supported
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, offset, length, getattr(os, advice))
+        except OSError:
+            pass
@@ -0,0 +1,132 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class Scheduler:
+    """ Admission control of the server's transfers.
+        At most max_transfers transfers run at a time and at most max_per_client of them for
+        a client IP (0 - no limit), the other requests wait in a bounded queue and are started
+        when a transfer finishes - first the request of the client with the fewest running
+        transfers, in the order they arrived. A request that can't be queued, or waited longer
+        than queue_timeout, is refused by a busy ERROR. With max_rate (bytes/s) the running
+        transfers are paced to an equal share of it, so a crowd of small transfers can't
+        take the bandwidth of the large ones """
+
+    START = 'start'
+    QUEUED = 'queued'
+    BUSY = 'busy'
+    DUPLICATE = 'duplicate' # a retransmitted request of a running or queued transfer
+    EXPIRE_INTERVAL = 1 # seconds between the expiry checks of an idle server
+
+    def __init__(self, max_transfers=0, max_per_client=0, max_pending=1024, queue_timeout=10, max_rate=0):
+        self.__max_transfers = max_transfers
+        self.__max_per_client = max_per_client
+        self.__max_pending = max_pending
+        self.__queue_timeout = queue_timeout
+        self.__max_rate = max_rate
+        self.__active = set() # client addresses (TIDs) of the running transfers
+        self.__clients = {} # client IP: running transfers
+        self.__pending = OrderedDict() # client address: (arrival time, request packet, main socket)
+        self.__expired = [] # (client address, main socket) of the dropped requests, not yet refused
+        self.__lock = threading.Lock()
+
+
+    @property
+    def Active(self):
+        return len(self.__active)
+
+    @property
+    def Pending(self):
+        return len(self.__pending)
+
+
+    def admissible(self, ip):
+        if self.__max_transfers and len(self.__active) >= self.__max_transfers:
+            return False
+        return not self.__max_per_client or self.__clients.get(ip, 0) < self.__max_per_client
+
+
+    def add(self, addr):
+        self.__active.add(addr)
+        self.__clients[addr[0]] = self.__clients.get(addr[0], 0) + 1
+
+
+    def submit(self, addr, packet, sock):
+        """ Return START (the transfer is counted as running), QUEUED, BUSY or DUPLICATE """
+
+        with self.__lock:
+            if addr in self.__active or addr in self.__pending:
+                return Scheduler.DUPLICATE
+
+            # the queued requests are not admissible (they are started once they are),
+            # a request that is doesn't overtake them
+            if self.admissible(addr[0]):
+                self.add(addr)
+                return Scheduler.START
+
+            if len(self.__pending) >= self.__max_pending:
+                return Scheduler.BUSY
+
+            # a copy of the packet, it's maybe a view of the reused receive buffer
+            self.__pending[addr] = (time.monotonic(), bytes(packet), sock)
+            return Scheduler.QUEUED
+
+
+    def release(self, addr):
+        """ The transfer of the client finished, return the queued requests
+            [(address, packet, socket), ...] to start now (they are counted as running) """
+
+        with self.__lock:
+            if addr not in self.__active:
+                return []
+            self.__active.discard(addr)
+            count = self.__clients.pop(addr[0]) - 1
+            if count:
+                self.__clients[addr[0]] = count
+            return self.next_requests()
+
+
+    def next_requests(self):
+        # the request of the client with the fewest running transfers first (the queue is
+        # bounded, scanning it is cheap), a client over its quota waits for its own transfers.
+        # A request that waited too long is not started, its client maybe gave up
+        self.drop_expired()
+        ready = []
+        while self.__pending:
+            candidates = [a for a in self.__pending if self.admissible(a[0])]
+            if not candidates:
+                break
+            addr = min(candidates, key=lambda a: self.__clients.get(a[0], 0)) # the first one on ties
+            arrival, packet, sock = self.__pending.pop(addr)
+            self.add(addr)
+            ready.append((addr, packet, sock))
+        return ready
+
+
+    def expire(self):
+        """ Remove and return the requests [(address, socket), ...] that waited longer than
+            the queue timeout (the client is maybe gone), they are refused """
+
+        with self.__lock:
+            self.drop_expired()
+            expired, self.__expired = self.__expired, []
+            return expired
+
+
+    def drop_expired(self):
+        deadline = time.monotonic() - self.__queue_timeout
+        while self.__pending:
+            addr, (arrival, packet, sock) = next(iter(self.__pending.items()))
+            if arrival > deadline:
+                break # the queue is in arrival order
+            del self.__pending[addr]
+            self.__expired.append((addr, sock))
+
+
+    def delay(self, nbytes):
+        """ Seconds a transfer waits after moving nbytes, to keep its share of the rate """
+
+        if not self.__max_rate or not nbytes:
+            return 0
+        return nbytes * max(len(self.__active), 1) / self.__max_rate
@@ -1,14 +1,34 @@
 #!/usr/bin/env python3
 import argparse
 import os
+import signal
 import socket
-from tftp import TFTP
+import stat
+import sys
+from tftp import TFTP, Transfer, buffers
+from blockio import BlockReader, BlockWriter
+from cache import BlockCache
+from netascii import NetasciiIndexes, NetasciiReader, NetasciiWriter
+from multicast import MulticastGroups
+from compress import CompressedFiles, CompressingReader, CompressedWriter, choose_codec, LEVEL
+from scheduler import Scheduler
+from fsindex import FileIndex
+from prefetch import Prefetcher
+from logger import log, setup_logging, transfer_summary
 import threading
+import multiprocessing
+import time
+from metrics import metrics, start_metrics
 
 class Server(TFTP):
 
+    BUSY = 'Server busy, try again later' # the message of the ERROR refusing an admission
+
     def __init__(self, port=69, buffer_size = 1024, is_logging = True, 
-                    timeout = 500, blksize = 512, transfer_mode= TFTP.TRANSFER_MODES[1]):
+                    timeout = 500, blksize = 512, transfer_mode= TFTP.TRANSFER_MODES[1], fsync = False,
+                    reuse_port = False, cache_size = 64 * 1024 * 1024, use_mmap = False, retries = 5, multicast = None,
+                    scheduler = None, index_interval = 0, prefetch = 0, prefetch_threads = Prefetcher.THREADS,
+                    compression = None):
 
         super().__init__(blksize, transfer_mode)
 
@@ -17,12 +37,154 @@ class Server(TFTP):
         self.__buffer_size = buffer_size
         self.__is_logging = is_logging # verbose messages       
         self.__timeout = timeout # timeout to waiting for the client
+        self.__retries = retries # retransmissions before giving up on the client
+        self.__fsync = fsync # fsync uploaded files once they are complete
+        self.__reuse_port = reuse_port # the TFTP port is shared by worker processes
+        # blocks of hot files shared by the RRQ transfers (0 - read every block from the file)
+        self.__cache = BlockCache(cache_size) if cache_size else None
+        self.__use_mmap = use_mmap # send the blocks of uncached files from their mapping
+        # the blocks of uncached files are read ahead (up to prefetch bytes per transfer) by
+        # a pool of I/O threads, 0 - read when the ACK asks them
+        self.__prefetcher = Prefetcher(prefetch, prefetch_threads) if prefetch else None
+        # block checkpoints of the files sent in netascii mode, shared by their readers
+        self.__netascii_indexes = NetasciiIndexes()
+        # the MulticastGroups streaming the files asked with the multicast option (RFC 2090),
+        # None - the option is not acknowledged
+        self.__multicast = multicast
+        # the Scheduler admitting the requests (caps, per-client quotas, a queue and the rate
+        # shares of the transfers), None - every valid request is started at once
+        self.__scheduler = scheduler
+        # the client addresses (TIDs) of the running transfers when there's no scheduler,
+        # a retransmitted request of a running transfer is ignored (the scheduler does it too)
+        self.__running = set()
+        self.__running_lock = threading.Lock()
+        # the CompressedFiles of the files asked with the compress option (their compressed
+        # versions are shared by the transfers), None - the option is not acknowledged
+        self.__compression = compression
+        # the in-memory index of the served directory (rescanned every index_interval seconds),
+        # None - the files are stat'ed by every request
+        caches = [cache for cache in (self.__cache, compression) if cache is not None]
+        self.__index = FileIndex('.', index_interval, caches) if index_interval else None
              
        
 
     def log(self, msg):
         if self.__is_logging:
-            print(msg)
+            log.info(msg)
+
+
+    def send_error(self, code, sock, addr, msg=None):
+        TFTP.send_packet(TFTP.pack_error(code, msg), sock, addr)
+        metrics.error_sent(code)
+
+
+    def finish_transfer(self, transfer, addr_client):
+        # one record per transfer at the default level, the packets are traced only on request
+        metrics.transfer_finished(transfer)
+        if self.__is_logging:
+            transfer_summary(transfer, Server.request_type(transfer), addr_client)
+        if Server.request_type(transfer) == 'WRQ':
+            # the size of the uploaded file
+            self.file_changed(transfer.stream.Filename)
+        self.end_request(addr_client)
+
+
+    def submit_request(self, packet_req, addr_client, main_sock):
+        """ Start the request now, queue it or refuse it when the server is overloaded
+            (by the scheduler), used by all the engines """
+
+        if self.__scheduler is None:
+            with self.__running_lock:
+                if addr_client in self.__running:
+                    return # the reply of the running transfer was lost, its timer resends it
+                self.__running.add(addr_client)
+            started = False
+            try:
+                started = self.start_request(packet_req, addr_client, main_sock)
+            finally:
+                if not started:
+                    self.end_request(addr_client)
+            return
+
+        self.expire_requests()
+
+        decision = self.__scheduler.submit(addr_client, packet_req, main_sock)
+        if decision == Scheduler.START:
+            try:
+                started = self.start_request(packet_req, addr_client, main_sock)
+            except Exception:
+                started = False
+                raise
+            finally:
+                if not started:
+                    self.end_request(addr_client)
+        elif decision == Scheduler.QUEUED:
+            # the client retransmits the request meanwhile, the copies are ignored
+            self.log(f"[QUEUED]: request of ({addr_client}), {self.__scheduler.Pending} waiting")
+        elif decision == Scheduler.BUSY:
+            self.send_error(0, main_sock, addr_client, Server.BUSY)
+            self.log(f"[BUSY]: the request of ({addr_client}) is refused, the queue is full")
+
+
+    def end_request(self, addr_client):
+        # the transfer of the client ended (or was not started), start the queued requests
+        # that got its place, the ones that fail to start give it to the next ones
+        if self.__scheduler is None:
+            with self.__running_lock:
+                self.__running.discard(addr_client)
+            return
+
+        ready = self.__scheduler.release(addr_client)
+        while ready:
+            addr, packet_req, main_sock = ready.pop(0)
+            try:
+                started = self.start_request(packet_req, addr, main_sock)
+            except Exception as e:
+                log.error("Error: %s", e)
+                started = False
+            if not started:
+                ready += self.__scheduler.release(addr)
+        # the requests dropped by the release (they waited too long) are refused
+        self.expire_requests()
+
+
+    def expire_requests(self):
+        """ Refuse the queued requests that waited longer than the queue timeout, it's called by
+            the requests and the ends of the transfers and periodically by an idle server """
+
+        if self.__scheduler is None:
+            return
+        for addr, sock in self.__scheduler.expire():
+            self.send_error(0, sock, addr, Server.BUSY)
+            self.log(f"[BUSY]: the request of ({addr}) waited too long in the queue")
+
+
+    def pace(self, transfer, nbytes):
+        """ Seconds the transfer waits after moving nbytes, to keep its share of the rate limit """
+        return self.__scheduler.delay(nbytes) if self.__scheduler is not None else 0
+
+
+    @staticmethod
+    def request_type(transfer):
+        return 'RRQ' if isinstance(transfer.stream, (BlockReader, NetasciiReader, CompressingReader)) else 'WRQ'
+
+
+    def file_info(self, filename):
+        """ Return (size, mtime_ns, inode) of the regular file, None if there's no such file """
+
+        if self.__index is not None:
+            return self.__index.lookup(filename)
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        return (st.st_size, st.st_mtime_ns, st.st_ino) if stat.S_ISREG(st.st_mode) else None
+
+
+    def file_changed(self, filename):
+        # the server created or wrote the file, or it's gone while indexed
+        if self.__index is not None:
+            self.__index.refresh(filename)
 
 
     def create_udp_socket(self, port):
@@ -34,8 +196,9 @@ class Server(TFTP):
     def validate_request(self, packet): 
         """ 
             Validate the client request RRQ/WRQ
-            If failed return the code error {0..7}  
-            Otherwise (-1 means succeeded)
+            Return (code error, options, info), the code error {0..8} if failed
+            Otherwise (-1 means succeeded), the parsed options and the file info
+            (size, mtime_ns, inode) are kept for the negotiation (None when not known)
         """
 
         opcode = self.get_opcode(packet)   
@@ -46,151 +209,458 @@ class Server(TFTP):
             
             #  Mail is not supported in this implementation
             if mode not in TFTP.TRANSFER_MODES or mode == 'mail':            
-                return 0 # 'Not Defined' ERROR
+                return 0, None, None # 'Not Defined' ERROR
 
             # Check if '/' is in filename - unwanted path for directories        
             if '/' in filename:           
-                return 2 # Access Violation' ERROR         
+                return 2, None, None # Access Violation' ERROR         
+
+            # Check the values of the requested options (blksize, timeout, tsize, windowsize)
+            options = self.unpack_rq_options(packet)
+            if not TFTP.check_options(options):
+                return 8, None, None # 'Option Negotiation Failed' ERROR
+
+            # the size of the file from the index of the served directory (or its stat)
+            info = self.file_info(filename)
 
             if opcode == TFTP.RRQ_OPCODE:                        
                 # Check if file doesn't exist, 
-                if not os.path.isfile(filename):               
-                    return 1 # 'File Not Found' ERROR                
+                if info is None:               
+                    return 1, None, None # 'File Not Found' ERROR                
+
+                # a range can't start after the end of the file
+                if TFTP.OPT_RANGE in options and \
+                        TFTP.parse_range(options[TFTP.OPT_RANGE])[0] > info[0]:
+                    return 8, None, None # 'Option Negotiation Failed' ERROR
 
             else: # WRQ request
                 # If file is exist in the server send a propriate 
-                if os.path.isfile(filename):               
-                    return 6 # ERROR ('File Already Exists')
+                # (the create with O_EXCL decides when the index is behind)
+                if info is not None:               
+                    return 6, None, None # ERROR ('File Already Exists')
 
             # Last try is to create the file - maybe other thread is creating it 
             
 
-            return -1
+            return -1, options, info
 
         # Client request is only RRG/WRQ, in any other case of opcode send a propriate error    
         # 'Illegal TFTP operation' ERROR   
-        return 4
+        return 4, None, None
 
 
+
+    def negotiate_options(self, opcode, filename, options, mode=TFTP.TRANSFER_MODES[1], info=None):
+        """ 
+            Return the accepted options of a validated request, 
+            they are sent back to the client in the OACK packet
+            (empty when the client did not request any known option)
+        """
+
+        accepted = {}
+        # the size of the file read (RRQ) as found by the validation, a file removed
+        # since then fails to open
+        size = info[0] if info is not None and opcode == TFTP.RRQ_OPCODE else 0
+
+        if TFTP.OPT_BLKSIZE in options:
+            # a larger block size than supported is answered with the maximum
+            accepted[TFTP.OPT_BLKSIZE] = min(int(options[TFTP.OPT_BLKSIZE]), TFTP.MAX_BLKSIZE)
+
+        if TFTP.OPT_TIMEOUT in options:
+            accepted[TFTP.OPT_TIMEOUT] = int(options[TFTP.OPT_TIMEOUT])
+
+        if TFTP.OPT_WINDOWSIZE in options:
+            accepted[TFTP.OPT_WINDOWSIZE] = int(options[TFTP.OPT_WINDOWSIZE])
+
+        # the netascii size and offsets of a file are only known once it's translated,
+        # the tsize and range options are not acknowledged in netascii mode
+        netascii_rrq = opcode == TFTP.RRQ_OPCODE and mode == TFTP.TRANSFER_MODES[0]
+
+        if TFTP.OPT_TSIZE in options and not netascii_rrq:
+            if opcode == TFTP.RRQ_OPCODE:
+                # the client asks the size of the file it reads (sends 0)
+                accepted[TFTP.OPT_TSIZE] = size
+            else:
+                # the client tells the size of the file it writes
+                accepted[TFTP.OPT_TSIZE] = int(options[TFTP.OPT_TSIZE])
+
+        if TFTP.OPT_RANGE in options and opcode == TFTP.RRQ_OPCODE and not netascii_rrq:
+            # the length is cut at the end of the file (the range is not an option of WRQ)
+            offset, length = TFTP.parse_range(options[TFTP.OPT_RANGE])
+            rest = size - offset
+            accepted[TFTP.OPT_RANGE] = f"{offset}:{rest if length is None else min(length, rest)}"
+
+        if TFTP.OPT_MULTICAST in options and self.__multicast is not None and opcode == TFTP.RRQ_OPCODE \
+                and mode == TFTP.TRANSFER_MODES[1] and TFTP.OPT_RANGE not in accepted \
+                and size // accepted.get(TFTP.OPT_BLKSIZE, self.BlckSize) < 0xFFFF:
+            # the group address is told by the session, the block numbers of a group can't roll over
+            accepted[TFTP.OPT_MULTICAST] = ''
+
+        if TFTP.OPT_COMPRESS in options and self.__compression is not None and mode == TFTP.TRANSFER_MODES[1] \
+                and TFTP.OPT_RANGE not in accepted and TFTP.OPT_MULTICAST not in accepted:
+            # the offsets of the range are in the file, the multicast clients may not ask it
+            codec = choose_codec(options[TFTP.OPT_COMPRESS])
+            if codec is not None:
+                accepted[TFTP.OPT_COMPRESS] = codec
+
+        return accepted
+
+
+    def handle_packet(self, transfer, packet_client, addr, client_sock, addr_client, mode):
+        """ Handle a packet received on the port of the transfer, shared by the engines
+            return True to wait for more packets, otherwise False to finalize the transfer """
+
+        # Check address (IP, port) matches initial connection address
+        if addr != addr_client:
+            self.send_error(5, client_sock, addr_client) # 'Unknown Transfer TID' ERROR 
+            return False
+
+        opcode = self.get_opcode(packet_client)
+
+        if opcode == TFTP.ACK_OPCODE:
+            return self.get_ack_send_dat(transfer, packet_client, client_sock, addr_client, mode)
+            
+        elif opcode == TFTP.DAT_OPCODE:
+            return self.get_dat_send_ack(transfer, packet_client, client_sock, addr_client)
+
+        elif opcode == TFTP.ERR_OPCODE:
+            # the client aborted the transfer (maybe declined the OACK), 
+            # an ERROR packet is never answered
+            opcode, error_code, error_msg = self.unpack_error(packet_client)
+            self.log(f"[Client Reply]: Error Message: {error_msg}, ERROR_CODE: ({error_code})")
+            return False
+
+        # Threads only handle incoming packets with ACK/DATA opcodes, send
+        # 'Illegal TFTP Operation' ERROR packet for any other opcode.
+        self.send_error(4, client_sock, addr_client)
+        return False
+
         
-    def handle_client(self, last_packet, client_sock, addr_client, filename, mode):
+    def handle_client(self, transfer, client_sock, addr_client, mode):
         """ Handle client request in new thread
-            read, write to files"""        
+            read, write to files
+            the stream of the transfer is the BlockReader of the requested file (RRQ) 
+            or the BlockWriter of the uploaded file (WRQ) """        
         
+        # the DATA packets are as large as the negotiated block size, they are received
+        # into a pooled buffer of the transfer (no allocation per packet)
+        buffer = buffers.acquire(max(self.__buffer_size, transfer.stream.BlckSize + 4))
+        view = memoryview(buffer)
+        moved = 0 # bytes of the transfer when the last packet was handled
+        finished = False # the transfer was closed and finished before the dally
+
         try:            
             
             while True:
                 try:                
-                    packet_client, addr = client_sock.recvfrom(self.__buffer_size)
-
-                    # Check address (IP, port) matches initial connection address
-                    if addr != addr_client:
-                        packet_err = self.pack_error(5) # 'Unknown Transfer TID' ERROR 
-                        TFTP.send_packet(packet_err, client_sock, addr_client)
+                    # wait until the retransmission timer expires
+                    client_sock.settimeout(transfer.timeout())
+                    if metrics.stage_timing:
+                        start = time.perf_counter()
+                        packet_client, addr = TFTP.receive(client_sock, view)
+                        metrics.stage('wait', time.perf_counter() - start)
+                    else:
+                        packet_client, addr = TFTP.receive(client_sock, view)
+
+                    if not self.handle_packet(transfer, packet_client, addr, client_sock, addr_client, mode):
+                        if transfer.final_acked:
+                            # the upload is complete: it was flushed (and fsynced) by the last block,
+                            # it's indexed and its slot given back before the dally
+                            transfer.close()
+                            self.finish_transfer(transfer, addr_client)
+                            finished = True
+                            self.dally(transfer, client_sock, addr_client, view)
                         break
 
-                    opcode = self.get_opcode(packet_client)
+                    # keep the share of the rate limit, the next window (or ACK) waits
+                    pause = self.pace(transfer, transfer.bytes - moved)
+                    moved = transfer.bytes
+                    if pause:
+                        time.sleep(pause)
 
-                    if opcode == TFTP.ACK_OPCODE:
-                        last_packet = self.get_ack_send_dat(last_packet, packet_client, filename, client_sock, addr_client, mode)  
-                        if last_packet is None:
-                            break   
-                        
-                    elif opcode == TFTP.DAT_OPCODE:
-                        result = self.get_dat_send_ack(packet_client, filename, client_sock, addr_client) 
-                        if result is None:
-                            break
-
-                    else:
-                        # Threads only handle incoming packets with ACK/DATA opcodes, send
-                        # 'Illegal TFTP Operation' ERROR packet for any other opcode.
-                        packet_err = self.pack_error(4)
-                        TFTP.send_packet(packet_err, client_sock, addr_client)
+                except socket.timeout:
+                    # resend the last packet, give up once the retry budget is spent 
+                    if not self.retransmit(transfer, client_sock, addr_client, mode):
+                        log.warning("Connection timeouts (%s)", addr_client)
                         break
 
+            return False
 
-                except socket.timeout:
-                    print("Connection timeouts")
-                    break
+        except Exception as e:
+            log.error("Transfer error (%s): %s", addr_client, e)
+            return False # returning from the thread's run() method ends the thread
 
+        finally:
             client_sock.close()
+            buffers.release(buffer)
+            if not finished:
+                # flush the written data also when the transfer failed
+                try:
+                    transfer.close()
+                except OSError as e:
+                    log.error("Transfer error (%s): %s", addr_client, e)
+                finally:
+                    self.finish_transfer(transfer, addr_client)
+
+
+    def create_main_socket(self):
+        # Create a datagram socket bound to the TFTP port, requests are received on it
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.__reuse_port:
+            # every worker process binds the port and the kernel spreads the requests
+            # between them (by the client address, a client always gets the same worker)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.__ip, self.__port))
+        return sock
+
+
+    def open_transfer(self, packet_req, addr_client, main_sock):
+        """ 
+            Validate the client request and open its transfer, used by all the engines
+            Return (transfer, packet, mode, timeout), the packet is the first one 
+            to send (OACK/ACK 0, None for the first DATA window)
+            Otherwise an error was sent to the client (or it joined a multicast session) 
+            and None is returned
+        """
+
+        # Check if something got wrong in the client request
+        code_error, options, info = self.validate_request(packet_req)
+        if code_error != -1:
+            # send error message to the client                     
+            self.send_error(code_error, main_sock, addr_client)
+
+            err_msg = TFTP.TFTP_ERRORS[code_error]
+            self.log(f"[ERROR] by {addr_client}, Code error({code_error}): {err_msg}")
+            return None # continue to wait for another client request 
+
+        # parse packet after validating
+        opcode, filename, mode = self.unpack_rq_header(packet_req)
+        options = self.negotiate_options(opcode, filename, options, mode, info)
+        blksize = options.get(TFTP.OPT_BLKSIZE, self.BlckSize)
+        timeout = options.get(TFTP.OPT_TIMEOUT, self.__timeout)
+        windowsize = options.get(TFTP.OPT_WINDOWSIZE, 1)
+
+        if TFTP.OPT_MULTICAST in options:
+            # the client joins the session streaming the file to a group (or starts it),
+            # the session answers by the OACK from its own port
+            self.log(f"[REQUEST RECEIVED]: RRQ (multicast) From ({addr_client})")
+            metrics.request('RRQ')
+            self.__multicast.join(self, (filename, blksize, windowsize), addr_client, options,
+                                    lambda: BlockReader(filename, blksize, cache=self.__cache, use_mmap=self.__use_mmap,
+                                                        prefetcher=self.__prefetcher),
+                                    timeout, self.__retries, mode)
+            return None
+
+        if opcode == TFTP.RRQ_OPCODE:
+            # open the file once for the whole transfer
+            try:
+                if mode == TFTP.TRANSFER_MODES[0]:
+                    reader = NetasciiReader(filename, blksize, indexes=self.__netascii_indexes)
+                elif TFTP.OPT_COMPRESS in options:
+                    # the blocks of the compressed version, compressed once for all the clients
+                    reader = CompressingReader(filename, blksize, options[TFTP.OPT_COMPRESS], 
+                                                self.__compression, windowsize)
+                else:
+                    offset, length = TFTP.parse_range(options.get(TFTP.OPT_RANGE, '0:'))
+                    reader = BlockReader(filename, blksize, cache=self.__cache, use_mmap=self.__use_mmap, 
+                                            offset=offset, length=length, prefetcher=self.__prefetcher)
+            except FileNotFoundError:
+                # removed after the last scan of the index
+                self.file_changed(filename)
+                self.send_error(1, main_sock, addr_client) # 'File Not Found' ERROR
+                return None
+            transfer = Transfer(reader, windowsize, timeout, self.__retries)
+            if options:
+                # the client acknowledges the OACK by ACK 0 and then gets the first window
+                packet = TFTP.pack_oack(options)
+            else:
+                # send first block size of bytes (like 512 bytes) once the port is open
+                packet = None
+            self.log(f"[REQUEST RECEIVED]: RRQ From ({addr_client})")
+            metrics.request('RRQ')
+        
+        else: # WRQ request
+           
+            # check if another thread (or worker process) by this time created the specific file
+            # it it has been created then returns an error "File already exists",
+            # creating with O_EXCL is atomic - only one request can win the race
+            try:
+                fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666) # create an empty filename (rw, less the umask) 
+            except FileExistsError:
+                self.file_changed(filename)
+                self.send_error(6, main_sock, addr_client) # ERROR ('File Already Exists')
+                return None # exit thread and wait for a new connection 
+            os.close(fd)
+            # the next requests see the file at once, not after the next scan
+            self.file_changed(filename)
+
+            if TFTP.OPT_COMPRESS in options:
+                # the uploaded blocks are decompressed as they arrive
+                writer = CompressedWriter(filename, blksize, options[TFTP.OPT_COMPRESS], fsync=self.__fsync, 
+                                            size=options.get(TFTP.OPT_TSIZE))
+            else:
+                writer = NetasciiWriter if mode == TFTP.TRANSFER_MODES[0] else BlockWriter
+                writer = writer(filename, blksize, fsync=self.__fsync, size=options.get(TFTP.OPT_TSIZE))
+            transfer = Transfer(writer, windowsize, timeout, self.__retries)
+            # the OACK takes the place of ACK 0
+            packet = TFTP.pack_oack(options) if options else TFTP.pack_ack(0)
+            self.log(f"[REQUEST RECEIVED]: WRQ From ({addr_client})")                    
+            metrics.request('WRQ')
+
+        return transfer, packet, mode, timeout
+
+
+    def open_client_socket(self, transfer, addr_client, timeout):
+        # open new port to send/recive files from the client
+        client_sock = self.create_udp_socket(port=0) # The OS will then pick an available port for you
+        self.log(f"Open a new port ({client_sock.getsockname()[1]}) for the client ({addr_client})")
+        client_sock.settimeout(timeout)
+        if isinstance(transfer.stream, (BlockWriter, NetasciiWriter, CompressedWriter)):
+            TFTP.fit_receive_buffer(client_sock, transfer)
+        return client_sock
+
+
+    def begin_transfer(self, transfer, packet, sock, addr_client, mode):
+        # send the first packet of the transfer from its own port
+        metrics.transfer_started(transfer, Server.request_type(transfer), addr_client)
+        if packet is None:
+            self.send_window(transfer, sock, addr_client, mode)
+            return
+
+        TFTP.send_packet(packet, sock, addr_client)  
+        transfer.last_packet = packet
+        transfer.arm()
+
+        if TFTP.get_opcode(packet) == TFTP.OACK_OPCODE:
+            self.log(f"[SEND OACK]: ({addr_client}) options({TFTP.unpack_oack(packet)[1]})")
+        else:
+            self.log(f"[SEND ACK]: ({addr_client}) ACK number({0})")
+
+
+    def start_request(self, packet_req, addr_client, main_sock):
+        """ Open the transfer of the request and serve it by a new thread,
+            return False if it was not started (an error was sent) """
+
+        try:
+            result = self.open_transfer(packet_req, addr_client, main_sock)
+        except Exception as e:
+            log.error("Error (%s): %s", addr_client, e)
+            return False
+
+        if result is None:
             return False
 
+        transfer, packet, mode, timeout = result
+        client_sock = None
+        try:
+            client_sock = self.open_client_socket(transfer, addr_client, timeout)
+            self.begin_transfer(transfer, packet, client_sock, addr_client, mode)
         except Exception as e:
-            print(e)
-            client_sock.close()
-            return False # returning from the thread's run() method ends the thread
+            log.error("Error (%s): %s", addr_client, e)
+            if client_sock is not None:
+                client_sock.close()
+            transfer.close()
+            return False
+
+        # open for each new client request a new thread                
+        threading.Thread(target=self.handle_client, args=(transfer, client_sock, addr_client, mode)).start()
+        return True
 
 
     def run_server(self):        
 
         self.log("Starting tftp server")
-        # Create a datagram socket
-        main_sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM) # UDP
-        # Bind to address and ip
-        main_sock.bind((self.__ip, self.__port))
+        # Create a datagram socket, bind to address and ip
+        main_sock = self.create_main_socket()
         self.log(f"TFTP server is listening on ({socket.gethostname(), self.__port})..")
 
+        # the requests are received into one reused buffer
+        view = memoryview(bytearray(self.__buffer_size))
+        if self.__scheduler is not None:
+            # wake up to refuse the requests that expired in the queue, also without traffic
+            main_sock.settimeout(Scheduler.EXPIRE_INTERVAL)
+
         # Listen for incoming datagrams
         while True:
 
             try:
                 # Waiting for recieving request message from the client
-                packet_req , addr_client = main_sock.recvfrom(self.__buffer_size)
-
-                # Check if something got wrong in the client request
-                code_error = self.validate_request(packet_req)
-                if code_error != -1:
-                    packet_err = TFTP.pack_error(code_error)
-
-                    # send error message to the client                     
-                    TFTP.send_packet(packet_err, main_sock, addr_client)
-
-                    err_msg = TFTP.TFTP_ERRORS[code_error]
-                    self.log(f"\n[ERROR] by {addr_client}, Code error({code_error}): {err_msg}\n")
-                    continue # continue to wait for another client request 
-
-                # parse packet after validating
-                opcode, filename, mode = self.unpack_rq_header(packet_req)
-
-                if opcode == TFTP.RRQ_OPCODE:
-                    # read first block size of bytes (like 512 bytes)
-                    packet = self.pack_data(1, filename, mode)
-                    self.log(f"\n[REQUEST RECEIVED]: RRQ From ({addr_client})\n")
-                
-                else: # WRQ request
-                   
-                    # check if another thread by this time created the specific file
-                    # it it has been created then returns an error "File already exists"
-                    if os.path.isfile(filename):  
-                        packet_err = TFTP.pack_error(6) # ERROR ('File Already Exists')
-                        TFTP.send_packet(packet_err, main_sock, addr_client)   
-                        continue # exit thread and wait for a new connection 
-                        
-                    with open(filename, 'w+'): # create an empty filename 
-                        pass
-
-                    packet = TFTP.pack_ack(0)
-                    self.log(f"\n[REQUEST RECEIVED]: WRQ From ({addr_client})\n")                    
-                
-                # open new port to send/recive files from the client
-                client_sock = self.create_udp_socket(port=0) # The OS will then pick an available port for you
-                self.log(f"\nOpen a new port ({client_sock.getsockname()[1]}) for the client ({addr_client})\n")
-                client_sock.settimeout(self.__timeout)
-                TFTP.send_packet(packet, client_sock, addr_client)  
-
-                if opcode == TFTP.RRQ_OPCODE:  
-                    self.log(f"[SEND DATA]: ({addr_client}) length({len(packet) - 4})")
-                else:
-                    self.log(f"[SEND ACK]: ({addr_client}) ACK number({0})")
+                packet_req , addr_client = TFTP.receive(main_sock, view)
+            except socket.timeout:
+                self.expire_requests()
+                continue
+            except OSError as e:
+                # like an ICMP error of a packet sent from the port, the next request is received
+                log.error("Error: %s", e)
+                continue
 
-                # open for each new client request a new thread                
-                threading.Thread(target=self.handle_client, args=(packet, client_sock, addr_client, filename, mode)).start()
-                    
+            try:
+                # started now, queued until a transfer ends or refused when overloaded
+                self.submit_request(packet_req, addr_client, main_sock)
             except Exception as e:
-                print("Error: ", e)
-                main_sock.close()
-
+                # only this request failed, the port keeps serving the others
+                log.error("Error (%s): %s", addr_client, e)
+
+
+
+def create_server(args, reuse_port=False):
+    kwargs = dict(timeout=args.timeout, retries=args.retries, fsync=args.fsync, reuse_port=reuse_port, 
+                    cache_size=args.cache_size * 1024 * 1024, use_mmap=args.mmap, index_interval=args.index_interval,
+                    prefetch=args.prefetch * 1024, prefetch_threads=args.prefetch_threads)
+    if args.max_transfers or args.max_per_client or args.max_rate:
+        kwargs['scheduler'] = Scheduler(args.max_transfers, args.max_per_client, args.max_pending, 
+                                        args.queue_timeout, int(args.max_rate * 1e6))
+    if args.multicast:
+        kwargs['multicast'] = MulticastGroups(args.multicast, args.multicast_port, args.multicast_ttl, args.multicast_if)
+    if args.compress:
+        kwargs['compression'] = CompressedFiles(args.compress_cache * 1024 * 1024, args.compress_level)
+
+    if args.engine == 'asyncio':
+        from aioserver import AsyncServer
+        return AsyncServer(args.port, **kwargs)
+
+    return Server(args.port, **kwargs)
+
+
+def run_worker(args, index):
+    # each worker process runs its own engine on the shared TFTP port
+    # (and its own logging thread, the threads are not forked)
+    setup_logging(args.log_level, args.trace_packets, args.trace_file)
+    # the metrics are per process, the worker N serves them on the metrics port + N
+    run_metrics(args, index)
+    try:
+        create_server(args, reuse_port=True).run_server()
+    except KeyboardInterrupt:
+        pass
+
+
+def run_metrics(args, index=None):
+    port = args.metrics_port
+    snapshot_file = args.metrics_file
+    if index is not None:
+        port = port and port + index
+        snapshot_file = snapshot_file and f"{snapshot_file}.{index}"
+    start_metrics(port, snapshot_file, args.metrics_interval, args.stage_timing)
+
+
+def run_workers(args):
+    """ Run the server in args.workers processes to use all the CPU cores """
+
+    workers = [multiprocessing.Process(target=run_worker, args=(args, index), daemon=True) 
+                for index in range(args.workers)]
+    for worker in workers:
+        worker.start()
+
+    # stop the workers also when the main process is terminated
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            worker.terminate()
 
 
 def main():
@@ -198,17 +668,83 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-p', '--port', dest='port', type=int,  default=69, help='server port')
     parser.add_argument('-t', "--timeout", dest='timeout', type=int, default=3, help="timeout to close the connection")
+    parser.add_argument('-r', "--retries", dest='retries', type=int, default=5, help="retransmissions of a packet before closing the connection")
     parser.add_argument('-c', '--cwd', dest='cwd', type=str, default='', help='Change the current directory in which the files (with relative paths) are read or written')
+    parser.add_argument('--fsync', dest='fsync', action='store_true', help='fsync uploaded files to the disk once they are complete')
+    parser.add_argument('-e', '--engine', dest='engine', choices=['thread', 'asyncio'], default='thread', 
+                            help='serve every transfer in its own thread or all of them on one asyncio event loop')
+    parser.add_argument('-w', '--workers', dest='workers', type=int, default=1, 
+                            help='number of server processes sharing the port (SO_REUSEPORT), like the number of CPU cores')
+    parser.add_argument('--cache-size', dest='cache_size', type=int, default=64, 
+                            help='memory budget in MB of the cache of hot files blocks (per worker), 0 disables it')
+    parser.add_argument('--mmap', dest='mmap', action='store_true', 
+                            help='send the blocks of uncached files from their memory mapping (the files must not be truncated while served)')
+    parser.add_argument('--prefetch', dest='prefetch', type=int, default=0, metavar='KB', 
+                            help='read the blocks of uncached files ahead of the ACKs, up to KB per transfer (default, 0 - no read-ahead)')
+    parser.add_argument('--prefetch-threads', dest='prefetch_threads', type=int, default=Prefetcher.THREADS, 
+                            help='I/O threads of the read-ahead (per worker, default 4)')
+    parser.add_argument('--log-level', dest='log_level', choices=['debug', 'info', 'warning', 'error'], default='info', 
+                            help='messages logged (info - requests and a summary of every transfer)')
+    parser.add_argument('--trace-packets', dest='trace_packets', type=int, default=0, metavar='N', 
+                            help='log 1 of every N packets (default, 0 - no per-packet logs)')
+    parser.add_argument('--trace-file', dest='trace_file', type=str, default=None, 
+                            help='write every packet as a JSON line to this file')
+    parser.add_argument('--metrics-port', dest='metrics_port', type=int, default=0, 
+                            help='serve the metrics on this local port (/metrics - Prometheus, /metrics.json), the worker N on port + N')
+    parser.add_argument('--metrics-file', dest='metrics_file', type=str, default=None, 
+                            help='write a JSON snapshot of the metrics to this file periodically (the worker N to PATH.N)')
+    parser.add_argument('--metrics-interval', dest='metrics_interval', type=float, default=10, 
+                            help='seconds between the JSON snapshots (default, 10)')
+    parser.add_argument('--stage-timing', dest='stage_timing', action='store_true', 
+                            help='time the read, pack, send and wait stages of every block (histograms of the metrics)')
+    parser.add_argument('--index-interval', dest='index_interval', type=float, default=0, metavar='SEC', 
+                            help='keep an in-memory index of the served files rescanned every SEC seconds, the requests '
+                                    'are validated without a stat (default, 0 - stat the file of every request)')
+    parser.add_argument('--max-transfers', dest='max_transfers', type=int, default=0, 
+                            help='transfers running at a time (per worker), the other requests wait in a queue (default, 0 - no limit)')
+    parser.add_argument('--max-per-client', dest='max_per_client', type=int, default=0, 
+                            help='transfers running at a time for a client IP (default, 0 - no limit)')
+    parser.add_argument('--max-pending', dest='max_pending', type=int, default=1024, 
+                            help='requests waiting for a transfer to end, the next ones are refused as busy (default, 1024)')
+    parser.add_argument('--queue-timeout', dest='queue_timeout', type=float, default=10, 
+                            help='seconds a request may wait in the queue before it is refused as busy (default, 10)')
+    parser.add_argument('--max-rate', dest='max_rate', type=float, default=0, metavar='MB/s', 
+                            help='rate limit of all the transfers (per worker), shared equally by the running ones (default, 0 - no limit)')
+    parser.add_argument('--multicast', dest='multicast', type=str, default=None, metavar='PREFIX', 
+                            help='stream the files asked with the multicast option to groups of this /16 prefix (like 239.255.0.0, RFC 2090)')
+    parser.add_argument('--multicast-port', dest='multicast_port', type=int, default=MulticastGroups.PORT, 
+                            help='port of the multicast groups (default, 1758)')
+    parser.add_argument('--multicast-ttl', dest='multicast_ttl', type=int, default=1, 
+                            help='hops of the multicast DATA packets (default, 1 - the local network)')
+    parser.add_argument('--multicast-if', dest='multicast_if', type=str, default=None, metavar='ADDR', 
+                            help='address of the interface sending to the groups (like 127.0.0.1 for the clients of the local host)')
+    parser.add_argument('--compress', dest='compress', action='store_true', 
+                            help='acknowledge the compress option, the files are sent (and uploaded) compressed by zlib')
+    parser.add_argument('--compress-cache', dest='compress_cache', type=int, default=64, metavar='MB', 
+                            help='memory budget in MB of the compressed versions of hot files (per worker), 0 - every transfer compresses its file')
+    parser.add_argument('--compress-level', dest='compress_level', type=int, default=LEVEL, 
+                            help='compression level (default, 6)')
    
     args = parser.parse_args()
+    if args.trace_file is not None:
+        args.trace_file = os.path.abspath(args.trace_file) # also for the workers after the chdir
+    if args.metrics_file is not None:
+        args.metrics_file = os.path.abspath(args.metrics_file)
+    setup_logging(args.log_level, args.trace_packets, args.trace_file)
 
     # change current working directory
     if args.cwd != '': 
         os.chdir(args.cwd)
 
-    server = Server(args.port, timeout=args.timeout)     
-    server.run_server()    
+    if args.workers > 1:
+        if hasattr(socket, 'SO_REUSEPORT'):
+            run_workers(args)
+            return
+        log.warning("SO_REUSEPORT is not supported by the system, running a single server process")
+
+    run_metrics(args)
+    create_server(args).run_server()    
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
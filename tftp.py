@@ -1,4 +1,9 @@
+import socket
 import struct
+import threading
+import time
+from logger import log, packets
+from metrics import metrics
 
 class TFTP:
 
@@ -7,6 +12,12 @@ class TFTP:
     DAT_OPCODE = 3
     ACK_OPCODE = 4
     ERR_OPCODE = 5
+    OACK_OPCODE = 6 # Option Acknowledgment (RFC 2347)
+
+    # |  OpCode  |  Block #  | header of DATA/ACK packets (and | OpCode | ErrorCode | of ERROR), 
+    # (!)-Network Big Endian, (H)-unsigned short integer 2 bytes
+    DAT_HEADER = struct.Struct('!HH')
+    OPCODE = struct.Struct('!H')
    
     TRANSFER_MODES = ['netascii', 'octet', 'mail']
 
@@ -18,9 +29,34 @@ class TFTP:
         4: 'Illegal TFTP operation',
         5: 'Unknown Transfer TID',
         6: 'File Already Exists',
-        7: 'No Such User'
+        7: 'No Such User',
+        8: 'Option Negotiation Failed'
     }
 
+    # Transfer options (RFC 2347 option extension)
+    OPT_BLKSIZE = 'blksize' # RFC 2348
+    OPT_TIMEOUT = 'timeout' # RFC 2349
+    OPT_TSIZE   = 'tsize'   # RFC 2349
+    OPT_WINDOWSIZE = 'windowsize' # RFC 7440
+    # extension: 'OFFSET:LENGTH' bytes of the file are read (RRQ), an empty LENGTH - up to
+    # the end of the file. Striped gets fetch the ranges of a file over parallel transfers
+    # and an interrupted get is resumed from the size of its partial target
+    OPT_RANGE = 'range'
+    OPT_MULTICAST = 'multicast' # RFC 2090 (see multicast.py)
+    # extension: the codecs the client takes ('zlib', a comma separated list in its order
+    # of preference), the OACK names the one used. The DATA blocks are blocks of the
+    # compressed file, the tsize is still the size of the file (see compress.py)
+    OPT_COMPRESS = 'compress'
+
+    DEFAULT_BLKSIZE = 512
+    MIN_BLKSIZE = 8
+    MAX_BLKSIZE = 65464
+    MIN_TIMEOUT = 1
+    MAX_TIMEOUT = 255
+    MIN_WINDOWSIZE = 1
+    MAX_WINDOWSIZE = 65535
+    MAX_RCVBUF = 64 * 1024 * 1024 # receive buffer asked for a window (the kernel caps it lower)
+
     def __init__(self, blksize, transfer_mode):
         self.__blksize = blksize
         self.__transfer_mode = transfer_mode
@@ -39,20 +75,19 @@ class TFTP:
         self.__blksize = blksize   
 
     
-    def read_file(self, block_no, filename):
-        # Read file in binary mode
-        with open(filename, 'rb') as f:
-            # the position of the read/write pointer within the file
-            # read each 512 bytes
-            offset = (block_no - 1) * self.BlckSize
-            # 0: The whence argument is optional and defaults to 0, which means absolute file positioning
-            f.seek(offset, 0)
-            # The number of bytes to return
-            content = f.read(self.BlckSize)
-        return content
-
-
-    def pack_data(self, block_no, filename, mode): 
+    def read_file(self, block_no, reader):
+        # The file is kept open by the transfer's BlockReader, it streams the blocks
+        # sequentially and seeks back only when a block is retransmitted
+        if not metrics.stage_timing:
+            return reader.read_block(block_no)
+
+        start = time.perf_counter()
+        data = reader.read_block(block_no)
+        metrics.stage('read', time.perf_counter() - start)
+        return data
+
+
+    def pack_data(self, block_no, reader, mode, header=None): 
         
         #       DATA Message:
         #       ----------------------------------------------
@@ -61,67 +96,235 @@ class TFTP:
         #       |    2 bytes    |  2 bytes  |   0-512 bytes  |
         #       ---------------------------------------------- 
 
-        # append data (read 512 bytes max from file) 
-        data = self.read_file(block_no, filename)   
-
-        # Parsing data into data packet
-        # { (!)-Network Big Endian, (H)-unsigned short integer 2 bytes, (s)-char[] bytes 
-        formatter = '!HH{}s'  
-        formatter = formatter.format(len(data))
-
-        # convert all data to bytes
-        return struct.pack(formatter, TFTP.DAT_OPCODE, block_no, data)
-
-    def get_dat_send_ack(self, packet, filename, sock, addr): 
+        # data (read 512 bytes max from file), a memoryview of the mapped file or 
+        # of the cached chunk - it is not copied
+        data = self.read_file(block_no, reader)   
+
+        # The packet is the (header, data) vector sent by one scatter-gather sendmsg,
+        # the header is packed into the reused buffer of the transfer
+        # { (!)-Network Big Endian, (H)-unsigned short integer 2 bytes 
+        if metrics.stage_timing:
+            start = time.perf_counter()
+        if header is None:
+            header = bytearray(TFTP.DAT_HEADER.size)
+        # the block number rolls over to 0 after 65535 on the wire
+        TFTP.DAT_HEADER.pack_into(header, 0, TFTP.DAT_OPCODE, block_no & 0xFFFF)
+        if metrics.stage_timing:
+            metrics.stage('pack', time.perf_counter() - start)
+        return header, data
+
+    def send_window(self, transfer, sock, addr, mode):
+        """ Send the DATA blocks of the window that follows the last acknowledged
+            block, (windowsize blocks are in flight, RFC 7440) """
+
+        block_no = transfer.acked + 1
+        end = transfer.acked + transfer.windowsize
+
+        while block_no <= end and (transfer.last_block is None or block_no <= transfer.last_block):
+            header, data = self.pack_data(block_no, transfer.stream, mode, transfer.header)    
+            if metrics.stage_timing:
+                start = time.perf_counter()
+                TFTP.send_packet((header, data), sock, addr)
+                metrics.stage('send', time.perf_counter() - start)
+            else:
+                TFTP.send_packet((header, data), sock, addr)
+
+            if packets.enabled:
+                packets.record('SEND DATA', addr, block_no, len(data))
+
+            if block_no > transfer.sent:
+                transfer.bytes += len(data)
+
+            # A DATA packet shorter than 516 (negotiated block size + 4) is the last one
+            if len(data) < transfer.stream.BlckSize:
+                transfer.last_block = block_no
+
+            transfer.sent = max(transfer.sent, block_no)
+            block_no += 1
+
+        # the retransmission timer runs from the (re)sent window
+        transfer.arm()
+
+
+    def get_dat_send_ack(self, transfer, packet, sock, addr): 
         """ Put packet in server/clinet that works the same way
             return True if it's not the last packet to send more packets
             otherwise return false to finalize work """       
         
         opcode, block_no, data = TFTP.unpack_dat(packet)
-                        
-        with open(filename, 'ab+') as f:
-            f.write(data)
-
-        print(f"[GET DATA]: ({addr}) length({len(data)})")    
+        # the internal block number of the 16-bit one (it rolls over on large files)
+        block_no = TFTP.unwrap_block(block_no, transfer.received + 1)
+
+        if packets.enabled:
+            packets.record('GET DATA', addr, block_no, len(data))
+
+        if block_no != transfer.received + 1:
+            # A duplicate (our ACK was lost) or a gap (a block of the window was lost),
+            # acknowledge once the last block received in order - the sender continues 
+            # (or rolls back) from there
+            if not transfer.dup_acked:
+                transfer.dup_acked = True
+                packet_ack = TFTP.pack_ack(transfer.received)       
+                TFTP.send_packet(packet_ack, sock, addr)
+                # the sender restarts its window after the acknowledged block (RFC 7440),
+                # the next ACK is due at the end of that window
+                transfer.acked = transfer.received
+                transfer.last_packet = packet_ack
+                if packets.enabled:
+                    packets.record('SEND ACK', addr, transfer.received)
+            return True
+
+        # (the block size is the negotiated one of the transfer)
+        is_last = len(data) < transfer.stream.BlckSize
+
+        # buffered by the transfer's BlockWriter, the file is flushed (and fsynced) by the
+        # last block - the final ACK tells the sender its data is safely written
+        try:
+            transfer.stream.write_block(block_no, data)
+            if is_last:
+                transfer.stream.close()
+        except DataError as e:
+            TFTP.send_packet(TFTP.pack_error(0, str(e)), sock, addr) # 'Not Defined' ERROR
+            raise
+        except OSError:
+            TFTP.send_packet(TFTP.pack_error(3), sock, addr) # 'Disk Full or Allocation Exceeded' ERROR
+            raise
+        transfer.received = block_no
+        transfer.bytes += len(data)
+        transfer.dup_acked = False
+        transfer.progress()
+
+        # Acknowledge the last block of the window, with windowsize 1 it's every block
+        if not is_last and block_no - transfer.acked < transfer.windowsize:
+            return True
 
         packet_ack = TFTP.pack_ack(block_no)       
         TFTP.send_packet(packet_ack, sock, addr)
+        transfer.acked = block_no
+        transfer.last_packet = packet_ack
+        transfer.arm()
 
-        print(f"[SEND ACK]: ({addr}) ACK number({block_no})")
+        if packets.enabled:
+            packets.record('SEND ACK', addr, block_no)
 
         # Close connection once all data has been received and final 
         # ACK packet has been sent
-        if len(data) < self.__blksize:
-            print('Last packet..')
-            return None # nothing is left to send
+        if is_last:
+            transfer.completed = True
+            transfer.final_acked = True # dally in case the final ACK is lost
+            return False # nothing is left to send
 
-        return packet_ack 
+        return True 
    
-    def get_ack_send_dat(self, last_packet, packet, filename, sock, addr, mode):
+    def get_ack_send_dat(self, transfer, packet, sock, addr, mode):
         """ Get ack packet and send data from server/clinet that works the same way
             return True if it's not the last packet to send more packets
             otherwise return false to finalize work""" 
     
         opcode, block_no = TFTP.unpack_ack(packet)    
+        # the internal block number of the 16-bit one (it rolls over on large files),
+        # an ACK acknowledges a block of the window in flight - otherwise it's an older one
+        block_no = transfer.acked + ((block_no - transfer.acked) & 0xFFFF)
+        if block_no > transfer.sent:
+            block_no -= 0x10000
         
-        print(f"[GET ACK]: ({addr}) ACK number({block_no})")  
-
-        # Check length of the last DATA packet sent, if the Datagram length is 
-        # less than 516 it is the last packet. Upon receiving the final ACK packet
-        # from the client we can terminate the connection.
-        if last_packet and len(last_packet) < self.BlckSize + 4 :
-            print('Last packet..')
-            return None
+        if packets.enabled:
+            packets.record('GET ACK', addr, block_no)
+
+        # Upon receiving the ACK of the last DATA packet (shorter than the block size) 
+        # we can terminate the connection.
+        if transfer.last_block is not None and block_no >= transfer.last_block:
+            transfer.completed = True
+            return False
+
+        if block_no < transfer.acked or block_no > transfer.sent:
+            # an ACK of an older window or of a block that was never sent
+            return True
+
+        if block_no == transfer.acked and transfer.sent > transfer.acked:
+            # A duplicate ACK - answering it would send every block twice from now on
+            # (Sorcerer's Apprentice), lost blocks are retransmitted by the timer.
+            # With a window it's the receiver telling a block was lost, roll back 
+            # and resend the window once
+            if transfer.windowsize == 1 or transfer.retries:
+                return True
+            transfer.retries += 1
+            transfer.retransmissions += 1
+        else:
+            # the window slides to the acknowledged block (an OACK is answered by ACK 0)
+            transfer.acked = block_no
+            transfer.progress()
+
+        self.send_window(transfer, sock, addr, mode)
+        return True       
+
+
+    def retransmit(self, transfer, sock, addr, mode):
+        """ Called when the retransmission timeout expired without an answer of the peer,
+            resend the window (sender) or the last ACK/OACK (receiver) with a backed off timeout
+            return False once the retry budget is spent to finalize work """
+
+        if transfer.retries >= transfer.max_retries:
+            return False
+
+        transfer.retries += 1
+        transfer.retransmissions += 1
+        transfer.rtt.backoff()
+        log.debug("[RETRANSMIT]: (%s) retry(%d) timeout(%.3f)", addr, transfer.retries, transfer.rtt.Rto)
+
+        if transfer.sent > transfer.acked:
+            # DATA blocks are not acknowledged yet
+            self.send_window(transfer, sock, addr, mode)
+            return True
+
+        if transfer.received > transfer.acked:
+            # the receiver got a part of the window, the sender continues from there
+            transfer.last_packet = TFTP.pack_ack(transfer.received)
+            transfer.acked = transfer.received
+
+        if transfer.last_packet is not None:
+            TFTP.send_packet(transfer.last_packet, sock, addr)
+        transfer.arm()
+        return True
+
+
+    def dally(self, transfer, sock, addr, view=None):
+        """ After the final ACK wait one timeout for a retransmitted last DATA packet
+            (the final ACK was lost) and acknowledge it again, view is the receive buffer
+            of the transfer (its stream is maybe closed already) """
+
+        deadline = time.monotonic() + transfer.rtt.Rto
+        if view is None:
+            view = memoryview(bytearray(transfer.stream.BlckSize + 4))
+
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+
+            sock.settimeout(remaining)
+            try:
+                packet, peer = TFTP.receive(sock, view)
+            except socket.timeout:
+                return
+
+            if peer == addr:
+                TFTP.answer_dally(transfer, packet, sock, addr)
 
-        packet_data = self.pack_data(block_no + 1, filename, mode)    
-        TFTP.send_packet(packet_data, sock, addr)
 
-        print(f"[SEND DATA]: ({addr}) length({len(packet_data) - 4})")
-        return packet_data       
+    @staticmethod
+    def answer_dally(transfer, packet, sock, addr):
+        # the data is complete, a retransmission of the last block is only acknowledged
+        # again (the earlier blocks of its window are covered by the same final ACK)
+        opcode, block_no = TFTP.unpack_header(packet)
+        if opcode == TFTP.DAT_OPCODE and block_no == transfer.received & 0xFFFF:
+            TFTP.send_packet(transfer.last_packet, sock, addr)
+            if packets.enabled:
+                packets.record('SEND ACK', addr, transfer.received)
 
 
     @staticmethod
-    def pack_rq_header(opcode, filename, mode):
+    def pack_rq_header(opcode, filename, mode, options=None):
         
         #       RRQ/WRQ Message:
         #       ---------------------------------------------------------------------
@@ -129,13 +332,39 @@ class TFTP:
         #       ---------------------------------------------------------------------
         #       |      2 bytes     |  2 bytes   |  1 byte  |  (n) bytes  |  1 byte  |
         #       ---------------------------------------------------------------------
+        #       followed by the requested options (RFC 2347):
+        #       ---------------------------------------------------------
+        #       |  opt1  |  All 0s  |  value1  |  All 0s  |  optN ...   |
+        #       ---------------------------------------------------------
 
         # { (!)-Network Big Endian, (H)-unsigned short integer 2 bytes, 
         # (s)-char[] bytes, unsigned char integer 1 byte}
         
         formatter = '!H{}sB{}sB' 
         formatter = formatter.format(len(filename), len(mode))
-        return struct.pack(formatter, opcode, filename.encode('utf-8'), 0, mode.encode('utf-8'), 0)
+        header = struct.pack(formatter, opcode, filename.encode('utf-8'), 0, mode.encode('utf-8'), 0)
+        return header + TFTP.pack_options(options)
+
+
+    @staticmethod
+    def pack_oack(options):
+
+        #       OACK Message:
+        #       ---------------------------------------------------------------------
+        #       |  OpCode(06)  |  opt1  |  All 0s  |  value1  |  All 0s  |  optN ...  |
+        #       ---------------------------------------------------------------------
+        #       |   2 bytes    |  (n) bytes  |  1 byte  |  (n) bytes  |  1 byte  |
+        #       ---------------------------------------------------------------------
+
+        return struct.pack('!H', TFTP.OACK_OPCODE) + TFTP.pack_options(options)
+
+
+    @staticmethod
+    def pack_options(options):
+        # every option is a pair of zero terminated strings: name, value
+        if not options:
+            return b''
+        return b''.join(f"{name}\x00{value}\x00".encode('utf-8') for name, value in options.items())
 
 
     @staticmethod
@@ -149,11 +378,12 @@ class TFTP:
         #       -----------------------------
     
         # { (!)-Network Big Endian, (H)-unsigned short integer 2 bytes
+        # the block number rolls over to 0 after 65535
         formatter = '!HH'  
-        return struct.pack(formatter, TFTP.ACK_OPCODE, block_no)
+        return struct.pack(formatter, TFTP.ACK_OPCODE, block_no & 0xFFFF)
 
     @staticmethod
-    def pack_error(error_code):
+    def pack_error(error_code, error_msg=None):
 
         #       ERROR Message:
         #       -------------------------------------------------------
@@ -164,8 +394,8 @@ class TFTP:
         
         # { (!)-Network Big Endian, (H)-unsigned short integer 2 bytes, (s)-char[] bytes 
         formatter = '!HH{}sB' 
-        # Get error string message and encode it
-        error_msg = TFTP.TFTP_ERRORS[error_code].encode('utf-8')
+        # Get error string message (the standard one of the code by default) and encode it
+        error_msg = (error_msg or TFTP.TFTP_ERRORS[error_code]).encode('utf-8')
         formatter = formatter.format(len(error_msg))
         return struct.pack(formatter, TFTP.ERR_OPCODE, error_code, error_msg, 0)
 
@@ -173,61 +403,310 @@ class TFTP:
     # Get opcode from TFTP header   
     @staticmethod 
     def get_opcode(packet):
-        # Read first two bytes in big indean format
-        opcode = int.from_bytes(packet[0:2], byteorder='big')           
+        # Read first two bytes in big indean format (the packet may be a memoryview of 
+        # the receive buffer, it's not sliced), a shorter packet has no valid opcode
+        if len(packet) < TFTP.OPCODE.size:
+            return 0
         # return like RRQ/WRQ/ACK..
-        return opcode 
+        return TFTP.OPCODE.unpack_from(packet)[0]
 
 
     # Return filename and mode from decoded RRQ/WRQ header   
     @staticmethod 
     def unpack_rq_header(packet):
         # |   OpCode(01/02)  |  Filename  |  All 0s  |    Mode     |  All 0s  |  
-        # skip the opcode part and split by zero byte
-        opcode = int.from_bytes(packet[0:2], byteorder='big')  # Extracting opcode
-        header = packet[2:].split(b'\x00') 
-        filename = header[0].decode('utf-8');
-        mode = header[1].decode('utf-8').lower()    
+        # the two strings end at the first zero bytes after the opcode (the options
+        # are not split), a missing mode is empty
+        packet = bytes(packet)
+        opcode = TFTP.get_opcode(packet)
+        filename_end, mode_end = TFTP.rq_header_ends(packet)
+        filename = packet[2:filename_end].decode('utf-8')
+        mode = packet[filename_end + 1:mode_end].decode('utf-8').lower()
         return opcode, filename, mode
 
+
+    @staticmethod
+    def rq_header_ends(packet):
+        # offsets of the zero bytes ending the filename and the mode (or the end of the packet)
+        filename_end = packet.find(b'\x00', 2)
+        if filename_end < 0:
+            return len(packet), len(packet)
+        mode_end = packet.find(b'\x00', filename_end + 1)
+        return filename_end, mode_end if mode_end >= 0 else len(packet)
+
+    
+    # Return the requested options of RRQ/WRQ header as {name: value}
+    @staticmethod 
+    def unpack_rq_options(packet):
+        # |  OpCode  |  Filename  |  0  |  Mode  |  0  |  opt1  |  0  |  value1  |  0  | ...
+        # skip opcode, filename and mode, the last field is empty (after the last zero byte)
+        packet = bytes(packet)
+        fields = packet[TFTP.rq_header_ends(packet)[1] + 1:].split(b'\x00')[:-1]
+        return TFTP.unpack_options(fields)
+
+
+    # OACK PACKET UNPACK  
+    @staticmethod 
+    def unpack_oack(packet):
+        # |  OpCode(06)  |  opt1  |  0  |  value1  |  0  | ...
+        opcode = TFTP.get_opcode(packet)  # Extracting opcode
+        fields = bytes(packet[2:]).split(b'\x00')[:-1]
+        return opcode, TFTP.unpack_options(fields)
+
+
+    @staticmethod 
+    def unpack_options(fields):
+        # option names are case insensitive, an incomplete trailing pair is ignored
+        options = {}
+        for name, value in zip(fields[0::2], fields[1::2]):
+            options[name.decode('utf-8').lower()] = value.decode('utf-8')
+        return options
+
+
+    @staticmethod 
+    def check_options(options):
+        """ Return True if the values of the known options are valid
+            (unknown options are ignored by RFC 2347) """
+
+        for name in (TFTP.OPT_BLKSIZE, TFTP.OPT_TIMEOUT, TFTP.OPT_TSIZE, TFTP.OPT_WINDOWSIZE):
+            if name in options and not TFTP.is_number(options[name]):
+                return False
+
+        if TFTP.OPT_BLKSIZE in options and int(options[TFTP.OPT_BLKSIZE]) < TFTP.MIN_BLKSIZE:
+            return False
+        
+        if TFTP.OPT_TIMEOUT in options and \
+                not TFTP.MIN_TIMEOUT <= int(options[TFTP.OPT_TIMEOUT]) <= TFTP.MAX_TIMEOUT:
+            return False
+
+        if TFTP.OPT_WINDOWSIZE in options and \
+                not TFTP.MIN_WINDOWSIZE <= int(options[TFTP.OPT_WINDOWSIZE]) <= TFTP.MAX_WINDOWSIZE:
+            return False
+
+        if TFTP.OPT_RANGE in options and TFTP.parse_range(options[TFTP.OPT_RANGE]) is None:
+            return False
+
+        return True
+
+
+    @staticmethod
+    def is_number(value):
+        # ASCII digits only, str.isdigit() also takes the digits int() rejects (like '²')
+        return value.isascii() and value.isdigit()
+
+
+    @staticmethod
+    def parse_range(value):
+        """ Return (offset, length) of a range option value (length is None up to 
+            the end of the file), None if the value is not valid """
+
+        offset, separator, length = value.partition(':')
+        if not separator or not TFTP.is_number(offset) or (length and not TFTP.is_number(length)):
+            return None
+        return int(offset), int(length) if length else None
+
     
     # DAT PACKET UNPACK  
     @staticmethod  
     def unpack_dat(packet):
         # |   OpCode(03)  |  Block #  |      Data      |
         # Packet like: '\x00\x03\x00\x01\xDATA'  
-        opcode   = int.from_bytes(packet[0:2], byteorder='big')  # Extracting opcode
-        block_no = int.from_bytes(packet[2:4], byteorder='big')  # Extracting Block number
-        data = packet[4:] 
+        opcode, block_no = TFTP.unpack_header(packet)  # Extracting opcode and Block number
+        # the data is a view of the packet (of the receive buffer), it's written without a copy
+        data = memoryview(packet)[TFTP.DAT_HEADER.size:]
         return opcode, block_no, data
 
 
+    @staticmethod  
+    def unpack_header(packet):
+        # |  OpCode  |  Block # (Error code)  |, a short packet is block 0
+        if len(packet) < TFTP.DAT_HEADER.size:
+            return TFTP.get_opcode(packet), 0
+        return TFTP.DAT_HEADER.unpack_from(packet)
+
+
+    # Internal block number of a 16-bit block number
+    @staticmethod  
+    def unwrap_block(block_no, expected):
+        # Transfers larger than 65535 blocks roll the block number over to 0, the internal
+        # number is unbounded (file offsets come from it) - take the closest one to the 
+        # expected block, a duplicate is just before it and a gap just after
+        delta = (block_no - expected) & 0xFFFF
+        if delta >= 0x8000:
+            delta -= 0x10000
+        return expected + delta
+
+
     # ACK PACKET UNPACK  
     @staticmethod  
     def unpack_ack(packet):
         # |   OpCode(04)  |  Block #  |
         # packet like: '\x00\x04\x00\x01'      
-        opcode   = int.from_bytes(packet[0:2] , byteorder='big')  # Extracting opcode
-        block_no = int.from_bytes(packet[2:]  , byteorder='big')  # Extracting Block number
-        return opcode, block_no
+        return TFTP.unpack_header(packet)  # Extracting opcode and Block number
 
 
     # ACK PACKET UNPACK  
     @staticmethod 
     def unpack_error(packet):    
         # |   OpCode(05)  |  ErrorCode  |   ErrMsg   |  All 0s  |       
-        opcode     = int.from_bytes(packet[0:2] , byteorder='big')  # Extracting opcode
-        error_code = int.from_bytes(packet[2:4]  , byteorder='big')  # Extracting error code        
-        error_msg  = packet[4:-1].decode('utf-8');  # Extracting error message
+        opcode, error_code = TFTP.unpack_header(packet)  # Extracting opcode and error code        
+        error_msg  = bytes(packet[4:-1]).decode('utf-8', 'replace')  # Extracting error message
         return opcode, error_code, error_msg
 
+    @staticmethod
+    def fit_receive_buffer(sock, transfer):
+        # a whole window of DATA packets may arrive before it is read (twice the
+        # payload for the kernel's per-packet overhead), the kernel caps the buffer 
+        # at its configured maximum
+        if hasattr(sock, 'get_extra_info'):
+            sock = sock.get_extra_info('socket') # the socket of an asyncio datagram transport
+        # (the size of the largest windows overflows the int of the socket option)
+        size = min(2 * transfer.windowsize * (transfer.stream.BlckSize + 4), TFTP.MAX_RCVBUF)
+        try:
+            if size > sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF):
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+        except (OSError, TypeError, OverflowError):
+            pass # best effort, the transfer runs with the default buffer
+
+    @staticmethod
+    def receive(sock, view):
+        # receive into the reused buffer (view - a memoryview of it) instead of a new bytes
+        # object per packet, the packet is a view valid until the next receive into the buffer
+        nbytes, addr = sock.recvfrom_into(view)
+        return view[:nbytes], addr
+
     @staticmethod
     def send_packet(packet, socket, addr):
-        socket.sendto(packet, addr)
+        if not isinstance(packet, tuple):
+            socket.sendto(packet, addr)
+        elif hasattr(socket, 'sendmsg'):
+            # (header, data) vector - gathered by the kernel, the data is not copied 
+            socket.sendmsg(packet, (), 0, addr)
+        else:
+            # asyncio datagram transports have no scatter-gather send
+            socket.sendto(b''.join(packet), addr)
+
+
+
+class DataError(Exception):
+    """ The received data can't be written (like a corrupt compressed stream),
+        the transfer is aborted and the peer gets an ERROR with the message """
+
+
+
+class BufferPool:
+    """ Receive buffers reused by the transfers, a transfer takes a buffer for its packets
+        and gives it back once it's finished (the pool keeps max_buffers of every size) """
+
+    MAX_BUFFERS = 64
+
+    def __init__(self, max_buffers=MAX_BUFFERS):
+        self.__max_buffers = max_buffers
+        self.__free = {} # size: [bytearray, ...]
+        self.__lock = threading.Lock()
+
+    def acquire(self, size):
+        with self.__lock:
+            free = self.__free.get(size)
+            if free:
+                return free.pop()
+        return bytearray(size)
+
+    def release(self, buffer):
+        with self.__lock:
+            free = self.__free.setdefault(len(buffer), [])
+            if len(free) < self.__max_buffers:
+                free.append(buffer)
+
+
+buffers = BufferPool()
+
+
+
+class Transfer:
+    """ State of a single RRQ/WRQ transfer, shared by the server and client loops
+        stream is the BlockReader of the sender or the BlockWriter of the receiver """
+
+    def __init__(self, stream, windowsize=1, timeout=3, retries=5, rtt=None):
+        self.stream = stream
+        self.windowsize = windowsize # blocks in flight before waiting for an ACK (RFC 7440)
+        # the timeout is the initial and the maximum retransmission timeout
+        self.rtt = rtt if rtt is not None else RttEstimator(timeout, timeout)
+        self.max_retries = retries
+        self.retries = 0 # retransmissions since the peer last answered
+        self.sent_at = 0 # time the last new packet was sent (for RTT samples)
+        self.timing = False # an RTT sample is pending
+        self.deadline = 0 # time the retransmission timer expires
+        self.final_acked = False # the receiver sent the final ACK
+        # statistics for the transfer summary
+        self.started = time.monotonic()
+        self.bytes = 0 # data bytes sent or received (not counting retransmissions)
+        self.retransmissions = 0
+        self.completed = False # all the data was acknowledged
+        # internal block numbers, the 16-bit block numbers on the wire roll over
+        self.acked = 0 # last acknowledged block
+        self.sent = 0 # highest DATA block sent
+        self.received = 0 # last DATA block received in order
+        self.last_block = None # number of the last (short) DATA block once it was read
+        self.last_packet = None # last (non DATA) packet sent to the peer
+        self.header = bytearray(TFTP.DAT_HEADER.size) # reused header of the DATA packets
+        self.dup_acked = False # a duplicate was already answered
+
+    def arm(self):
+        # a new packet was sent, time its answer and start the retransmission timer
+        self.sent_at = time.monotonic()
+        self.timing = True
+        self.deadline = self.sent_at + self.rtt.Rto
+
+    def progress(self):
+        # the peer answered - by Karn's algorithm the RTT of a retransmitted 
+        # packet is not sampled (it's unknown which copy was answered)
+        now = time.monotonic()
+        if self.timing and self.retries == 0:
+            self.rtt.sample(now - self.sent_at)
+        self.timing = False
+        self.retries = 0
+        self.deadline = now + self.rtt.Rto
+
+    def timeout(self):
+        # seconds left until the retransmission timer expires
+        return max(self.deadline - time.monotonic(), 0.001)
+
+    def close(self):
+        self.stream.close()
+
+
+
+class RttEstimator:
+    """ Retransmission timeout (RTO) computed from the measured round trip times,
+        smoothed RTT and RTT variation as TCP does (RFC 6298), doubled by every 
+        retransmission until a new sample is measured """
+
+    MIN_RTO = 0.1 # seconds
 
-    
+    def __init__(self, initial, maximum):
+        self.__srtt = None
+        self.__rttvar = None
+        self.__maximum = maximum
+        self.__rto = min(initial, maximum)
 
+    @property
+    def Rto(self):
+        return self.__rto
 
+    @property
+    def Srtt(self):
+        return self.__srtt
 
+    def sample(self, rtt):
+        if self.__srtt is None:
+            self.__srtt = rtt
+            self.__rttvar = rtt / 2
+        else:
+            self.__rttvar = 0.75 * self.__rttvar + 0.25 * abs(self.__srtt - rtt)
+            self.__srtt = 0.875 * self.__srtt + 0.125 * rtt
 
+        self.__rto = min(max(self.__srtt + 4 * self.__rttvar, RttEstimator.MIN_RTO), self.__maximum)
 
+    def backoff(self):
+        self.__rto = min(self.__rto * 2, self.__maximum)